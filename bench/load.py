@@ -0,0 +1,414 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import ast
+import httplib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "sdrop"))
+
+import sdrop
+from lib import baseserver
+
+__doc__ = """
+end-to-end load test: start an SDropServer on loopback
+(in a process of its own, with a temporary root; with PROCESSES
+above 1, a baseserver.Prefork of that many), drive it with
+concurrent clients, and report throughput, latency percentiles,
+the server's CPU time per GiB moved, and its syscall counts
+(its workers' included)
+
+each client is a process with one persistent connection, running
+a weighted mix of requests: a POST uploads a new drop (of one of
+the sizes, chosen at random), a HEAD checks one of its own drops,
+and a GET fetches (and so consumes) one, uploading first
+if it has none left
+
+every combination of mix and concurrency is run against a fresh
+server; the results are written as JSON (with --compare, each run
+is also compared against the matching run in an earlier file)
+
+syscalls are counted from /proc (read- and write-class calls only,
+as /proc/PID/io reports them), so they're only available on Linux
+
+usage: python bench/load.py [--mix post=1,get=1,head=1]...
+    [--concurrency 1,8,32] [--sizes 4k,64k,1m] [--duration SECONDS]
+    [--scheduler multiplexing|pipelining|blocking] [--threads N]
+    [--set CONFIG=VALUE]... [--output FILE] [--compare FILE]
+"""
+
+METHODS = ("GET", "HEAD", "POST")
+PERCENTILES = (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+SCHEDULERS = {"blocking": lambda n: baseserver.threaded.Blocking(),
+    "multiplexing": lambda n: baseserver.threaded.Multiplexing(),
+    "pipelining": lambda n: baseserver.threaded.Pipelining(nthreads = n)}
+UNITS = {'': 1, 'k': 1024, 'm': 1048576, 'g': 1073741824}
+
+def parse_mix(text):
+    """parse "method=weight,..." into a {method: weight} dictionary"""
+    mix = {}
+
+    for item in text.split(','):
+        method, weight = item.split('=', 1)
+        method = method.strip().upper()
+
+        if not method in METHODS:
+            raise ValueError("unknown method: %s" % method)
+        mix[method] = float(weight)
+    return mix
+
+def parse_size(text):
+    """parse a size with an optional k, m or g suffix"""
+    text = text.strip().lower()
+
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+def parse_value(text):
+    """parse a configuration value (a Python literal, or else a string)"""
+    try:
+        return ast.literal_eval(text)
+    except (SyntaxError, ValueError):
+        return text
+
+def percentiles(latencies):
+    """summarize latencies (in seconds) with percentiles, in milliseconds"""
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    summary = {"count": len(latencies),
+        "mean": 1e3 * sum(latencies) / len(latencies),
+        "max": 1e3 * latencies[-1]}
+
+    for name, fraction in PERCENTILES:
+        summary[name] = 1e3 * latencies[min(len(latencies) - 1,
+            int(fraction * len(latencies)))]
+    return summary
+
+def proc_counters(pid):
+    """
+    return a process's (and its children's) CPU seconds and,
+    when /proc allows, its read and write syscalls and context switches
+    """
+    counters = {"cpu_seconds": 0.0}
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    pids = [pid]
+
+    try: # prefork workers
+        for name in os.listdir("/proc"):
+            if name.isdigit() and not int(name) == pid:
+                with open("/proc/%s/stat" % name) as fp:
+                    fields = fp.read().rsplit(')', 1)[1].split()
+
+                if int(fields[1]) == pid:
+                    pids.append(int(name))
+    except (IOError, OSError):
+        pass
+
+    for p in pids:
+        try:
+            with open("/proc/%u/stat" % p) as fp:
+                fields = fp.read().rsplit(')', 1)[1].split()
+            counters["cpu_seconds"] += (int(fields[11]) + int(fields[12])) \
+                / ticks
+
+            with open("/proc/%u/io" % p) as fp:
+                for line in fp:
+                    key, value = line.split(':')
+
+                    if key in ("syscr", "syscw"):
+                        counters[key] = counters.get(key, 0) + int(value)
+
+            for task in os.listdir("/proc/%u/task" % p): # every thread's
+                with open("/proc/%u/task/%s/status" % (p, task)) as fp:
+                    for line in fp:
+                        if "ctxt_switches:" in line:
+                            key, value = line.split(':')
+                            counters[key] = counters.get(key, 0) + int(value)
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return counters
+
+def serve(config, scheduler, threads, conn):
+    """run a server (in its own process), sending its port through conn"""
+    root = tempfile.mkdtemp(prefix = "sdrop-load-")
+    devnull = open(os.devnull, "w")
+
+    def mkserver(worker = 0):
+        server = sdrop.SDropServer(root = root, sock_config = config,
+            stderr = devnull, stdout = devnull, worker = worker)
+        server.thread(SCHEDULERS[scheduler](threads))
+        return server
+
+    try:
+        if config.PROCESSES > 1: # (it stops its workers on SIGTERM)
+            server = baseserver.Prefork(mkserver, config, config.PROCESSES,
+                stderr = devnull, stdout = devnull)
+        else:
+            server = mkserver()
+            signal.signal(signal.SIGTERM,
+                lambda signum, frame: server.kill())
+        conn.send(config.ADDRESS[1])
+        conn.close()
+        server()
+    finally:
+        shutil.rmtree(root, True)
+
+def start_server(overrides, scheduler, threads):
+    """start a server process, and return (process, port)"""
+    class LoadConfig(sdrop.SDropConfig):
+        ADDRESS = ("127.0.0.1", 0)
+
+    for k, v in overrides.items():
+        setattr(LoadConfig, k, v)
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target = serve,
+        args = (LoadConfig, scheduler, threads, child))
+    process.start()
+    deadline = time.time() + 30
+
+    if parent.poll(30):
+        port = parent.recv()
+
+        while time.time() < deadline: # (prefork workers listen once up)
+            try:
+                socket.create_connection(("127.0.0.1", port), 1).close()
+                return process, port
+            except socket.error:
+                time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("the server didn't start")
+
+def client(port, mix, sizes, deadline, seed, queue):
+    """run requests until deadline, then put the results on queue"""
+    rng = random.Random(seed)
+    bodies = dict((size, os.urandom(size)) for size in set(sizes))
+    conn = None
+    drops = []
+    methods = sorted(mix.keys())
+    weights = [mix[m] for m in methods]
+    results = {"errors": 0, "latencies": dict((m, []) for m in METHODS),
+        "octets": 0}
+    serial = 0
+
+    while time.time() < deadline:
+        method = methods[-1]
+        point = rng.random() * sum(weights)
+
+        for m, w in zip(methods, weights):
+            if point < w:
+                method = m
+                break
+            point -= w
+
+        if not method == "POST" and not drops:
+            method = "POST"
+        body = None
+
+        if method == "POST":
+            serial += 1
+            path = "/load-%u-%u" % (seed, serial)
+            body = bodies[rng.choice(sizes)]
+        elif method == "GET":
+            path = drops.pop(rng.randrange(len(drops)))
+        else:
+            path = rng.choice(drops)
+        start = time.time()
+
+        try:
+            if not conn:
+                conn = httplib.HTTPConnection("127.0.0.1", port, timeout = 30)
+            conn.request(method, path, body)
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            results["errors"] += 1
+
+            if conn:
+                conn.close()
+                conn = None
+            continue
+        results["latencies"][method].append(time.time() - start)
+        results["octets"] += len(data) + len(body or "")
+
+        if not response.status == 200:
+            results["errors"] += 1
+        elif method == "POST":
+            drops.append(path)
+
+        if (response.getheader("connection") or "").lower() == "close":
+            conn.close()
+            conn = None
+
+    if conn:
+        conn.close()
+    queue.put(results)
+
+def run(args, mix, concurrency):
+    """run one combination, and return its results"""
+    process, port = start_server(args.overrides, args.scheduler,
+        args.threads)
+
+    try:
+        queue = multiprocessing.Queue()
+        before = proc_counters(process.pid)
+        started = time.time()
+        deadline = started + args.duration
+        clients = [multiprocessing.Process(target = client,
+                args = (port, mix, args.sizes, deadline, i, queue))
+            for i in range(concurrency)]
+
+        for c in clients:
+            c.start()
+        results = [queue.get() for c in clients]
+        elapsed = time.time() - started
+        after = proc_counters(process.pid)
+
+        for c in clients:
+            c.join()
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(10)
+
+        if process.is_alive():
+            process.terminate()
+    latencies = dict((m, sum((r["latencies"][m] for r in results), []))
+        for m in METHODS)
+    every = sum(latencies.values(), [])
+    octets = sum(r["octets"] for r in results)
+    server = dict((k, after[k] - before.get(k, 0)) for k in after)
+    gib = octets / float(UNITS['g'])
+
+    if gib:
+        server["cpu_seconds_per_gib"] = server["cpu_seconds"] / gib
+
+    if every:
+        for k in ("syscr", "syscw"):
+            if k in server:
+                server[k + "_per_request"] = server[k] / float(len(every))
+    return {"concurrency": concurrency,
+        "errors": sum(r["errors"] for r in results),
+        "latency_ms": dict([("all", percentiles(every))]
+            + [(m, percentiles(latencies[m])) for m in METHODS
+                if latencies[m]]),
+        "mix": mix, "requests": len(every), "seconds": elapsed,
+        "server": server,
+        "throughput": {"megabytes_per_second": octets / elapsed / 1e6,
+            "octets": octets, "requests_per_second": len(every) / elapsed}}
+
+def describe(result):
+    """return a line summarizing a run"""
+    latency = result["latency_ms"]["all"] or {}
+    return "%-28s c=%-4u %9.1f req/s %8.1f MB/s p50 %7.2f p99 %7.2f" \
+        " p999 %7.2f ms %7.2f CPU s/GiB %u errors" % (
+            ",".join("%s=%g" % kv for kv in sorted(result["mix"].items())),
+            result["concurrency"],
+            result["throughput"]["requests_per_second"],
+            result["throughput"]["megabytes_per_second"],
+            latency.get("p50", 0), latency.get("p99", 0),
+            latency.get("p999", 0),
+            result["server"].get("cpu_seconds_per_gib", 0), result["errors"])
+
+def compare(results, path):
+    """print each run's change against the matching run in path"""
+    with open(path) as fp:
+        earlier = json.load(fp)["runs"]
+
+    for result in results:
+        for old in earlier:
+            if old["mix"] == result["mix"] \
+                    and old["concurrency"] == result["concurrency"]:
+                break
+        else:
+            continue
+        changes = []
+
+        for name, get in (("req/s", lambda r: r["throughput"][
+                    "requests_per_second"]),
+                ("p99", lambda r: (r["latency_ms"]["all"] or {}).get("p99")),
+                ("CPU/GiB", lambda r: r["server"].get(
+                    "cpu_seconds_per_gib"))):
+            a, b = get(old), get(result)
+
+            if a and not b == None:
+                changes.append("%s %+.1f%%" % (name, 100.0 * (b - a) / a))
+        print "%-28s c=%-4u %s" % (",".join("%s=%g" % kv
+                for kv in sorted(result["mix"].items())),
+            result["concurrency"], "  ".join(changes))
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog = "bench/load.py",
+        description = "end-to-end load test for sdrop")
+    parser.add_argument("--compare", help = "an earlier results file")
+    parser.add_argument("--concurrency", default = "1,8,32",
+        help = "comma-separated client counts")
+    parser.add_argument("--duration", default = 10, type = float,
+        help = "seconds per run")
+    parser.add_argument("--mix", action = "append",
+        help = "method weights, e.g. post=1,get=1,head=1 (repeatable)")
+    parser.add_argument("--output", help = "where to write the results"
+        " (load-TIMESTAMP.json by default)")
+    parser.add_argument("--scheduler", choices = sorted(SCHEDULERS.keys()),
+        default = "multiplexing")
+    parser.add_argument("--set", action = "append", default = [],
+        dest = "overrides", metavar = "CONFIG=VALUE",
+        help = "override an SDropConfig attribute (repeatable)")
+    parser.add_argument("--sizes", default = "4k,64k,1m",
+        help = "comma-separated POST sizes")
+    parser.add_argument("--threads", default = 4, type = int,
+        help = "pipelining threads")
+    args = parser.parse_args(argv[1:])
+    args.overrides = dict((k.strip(), parse_value(v)) for k, v
+        in (o.split('=', 1) for o in args.overrides))
+    args.sizes = [parse_size(s) for s in args.sizes.split(',')]
+    mixes = [parse_mix(m) for m in args.mix or ["post=1,get=1,head=1"]]
+    levels = [int(c) for c in args.concurrency.split(',')]
+    output = args.output or time.strftime("load-%Y%m%d-%H%M%S.json")
+    results = []
+    started = time.time()
+
+    for mix in mixes:
+        for concurrency in levels:
+            results.append(run(args, mix, concurrency))
+            print describe(results[-1])
+    report = {"config": dict((k, repr(v)) for k, v
+            in args.overrides.items()),
+        "duration": args.duration, "platform": platform.platform(),
+        "python": platform.python_version(), "runs": results,
+        "scheduler": args.scheduler, "sizes": args.sizes,
+        "started": started, "threads": args.threads}
+
+    with open(output, "w") as fp:
+        json.dump(report, fp, indent = 1, sort_keys = True)
+    print "results written to %s" % output
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main(sys.argv)
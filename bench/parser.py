@@ -0,0 +1,129 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "sdrop"))
+
+from lib.baseserver import basehttpserver
+
+__doc__ = """
+benchmark request parsing:
+the buffered parser (HTTPReader) against the original octet-by-octet parser
+
+usage: python bench/parser.py [ITERATIONS]
+"""
+
+class LegacyHTTPHeaders(basehttpserver.HTTPHeaders):
+    """the original header parser: fp.read(1) per octet"""
+
+    def fload(self, fp):
+        line = []
+
+        while not "".join(line) in ("\n", "\r\n"):
+            try:
+                line.append(fp.read(1))
+            except socket.timeout:
+                continue
+
+            if line and line[-1] == '\n':
+                if ':' in line:
+                    k, v = "".join(line).split(':', 1)
+                    v = v.strip()
+
+                    for _type in (int, float):
+                        try:
+                            v = _type(v)
+                            break
+                        except ValueError:
+                            pass
+                    self.add(k.strip(), v)
+                    line = []
+                elif "".join(line).rstrip("\r\n"):
+                    line = list("".join(line).strip() + ' ')
+
+class LegacyHTTPRequest(basehttpserver.HTTPRequest):
+    """the original request parser: fp.read(1) per octet"""
+
+    def fload(self, fp):
+        self.method = []
+        self.resource = []
+        self.version = []
+
+        while not self.method or not self.method[-1] == ' ':
+            self.method.append(fp.read(1))
+        self.method = "".join(self.method).strip()
+
+        while not self.resource or not self.resource[-1] == ' ':
+            self.resource.append(fp.read(1))
+        self.resource = "".join(self.resource).strip()
+
+        while not self.version or not self.version[-1] == '\n':
+            self.version.append(fp.read(1))
+        self.version = "".join(self.version).strip()
+        self.version = float(self.version[self.version.rfind('/') + 1:])
+        self.headers = LegacyHTTPHeaders()
+        self.headers.fload(fp)
+
+def mkrequest(nheaders, body = ""):
+    """return a POST request with nheaders headers"""
+    lines = ["POST /some/drop/name HTTP/1.1",
+        "Content-Length: %u" % len(body)]
+
+    for i in range(nheaders - 1):
+        lines.append("X-Header-%u: %s" % (i, "v" * 32))
+    return "\r\n".join(lines + ["", ""]) + body
+
+def bench(name, request, load, iterations):
+    """parse request from a socket iterations times, and print the rate"""
+    a, b = socket.socketpair()
+    elapsed = 0
+
+    try:
+        for i in range(iterations):
+            a.sendall(request)
+            start = time.time()
+            load(b)
+            elapsed += time.time() - start
+    finally:
+        a.close()
+        b.close()
+    print "%-10s %9.0f requests/s %9.2f us/request" % (name,
+        iterations / elapsed, 1e6 * elapsed / iterations)
+
+def load_buffered(conn):
+    basehttpserver.HTTPRequest().fload(basehttpserver.HTTPReader(conn))
+
+def load_legacy(conn):
+    LegacyHTTPRequest().fload(conn.makefile())
+
+def main(argv):
+    iterations = 2000
+
+    if len(argv) > 1:
+        iterations = int(argv[1])
+
+    for nheaders in (4, 16, 64):
+        request = mkrequest(nheaders)
+        print "%u headers (%u octets):" % (nheaders, len(request))
+        bench("legacy", request, load_legacy, iterations)
+        bench("buffered", request, load_buffered, iterations)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,92 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "sdrop"))
+
+from lib import keystream, shred
+
+__doc__ = """
+benchmark shred patterns:
+how fast each one generates data, and how fast it shreds a file
+(overwriting and syncing), against the original os.urandom path
+
+usage: python bench/shred.py [MEGABYTES] [DIRECTORY]
+"""
+
+BUFSIZE = 1048576
+
+def bench_fill(name, pattern, size):
+    """time generating size octets per pass, and print the rate"""
+    instance = pattern()
+    start = time.time()
+
+    for _pass in range(pattern.PASSES):
+        for offset in range(0, size, BUFSIZE):
+            instance.fill(min(BUFSIZE, size - offset), _pass)
+    elapsed = time.time() - start
+    print "%-10s fill  %9.1f MB/s" % (name,
+        pattern.PASSES * size / elapsed / 1e6)
+
+def bench_shred(name, pattern, size, directory):
+    """time shredding a size-octet file, and print the rate"""
+    fd, path = tempfile.mkstemp(dir = directory)
+
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write('\0' * size)
+            fp.flush()
+            os.fsync(fp.fileno())
+        start = time.time()
+
+        for octets in shred.ShredJob(path, BUFSIZE, pattern):
+            pass
+        elapsed = time.time() - start
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    print "%-10s shred %9.1f MB/s %9.3f s" % (name, size / elapsed / 1e6,
+        elapsed)
+
+def main(argv):
+    directory = None
+    size = 64
+
+    if len(argv) > 1:
+        size = int(argv[1])
+
+    if len(argv) > 2:
+        directory = argv[2]
+    size *= 1048576
+    print "keystream: %s" % keystream.MECHANISM
+    tempdir = tempfile.mkdtemp(dir = directory)
+
+    try:
+        for name in sorted(shred.PATTERNS.keys()):
+            bench_fill(name, shred.PATTERNS[name], size)
+
+        for name in sorted(shred.PATTERNS.keys()):
+            bench_shred(name, shred.PATTERNS[name], size, tempdir)
+    finally:
+        shutil.rmtree(tempdir, True)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -13,7 +13,16 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import accounting
 import baseserver
+import compress
 import conf
+import cryptoerase
+import expiry
+import index
+import keystream
+import partial
+import ramtier
+import shred
 
 __doc__ = "library"
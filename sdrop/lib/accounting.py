@@ -0,0 +1,225 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import stat
+import thread
+
+import baseserver
+
+__doc__ = "live space accounting for a drop root"
+
+class Accounting:
+    """
+    keep track of the octets under a drop root
+
+    an upload reserves its declared length up front (reserve),
+    or, when its length isn't known, reserves more as it goes (extend);
+    that becomes the drop's size once it's stored (commit)
+    or is given back if it fails (abort); a fetched drop moves
+    from the stored total to the shredding total when it's claimed,
+    and leaves that once it's unlinked (a drop that was never on disk
+    is simply released)
+
+    limits (None for no limit):
+        capacity: octets for the whole root
+            (reserved + stored + shredding)
+        client_quota: octets per client (reserved + stored)
+        max_drop: octets per drop
+    and min_free octets are always left free on the filesystem
+    (counting outstanding reservations as already used)
+
+    the root is only scanned on startup (or its drops taken from
+    a DropIndex, leaving only the shred directory to list);
+    drops found then belong to no client
+    """
+
+    def __init__(self, root, shred_directory, capacity = None,
+            client_quota = None, max_drop = None, min_free = 0,
+            index = None):
+        self.capacity = capacity
+        self.client_quota = client_quota
+        self.clients = {} # client -> octets
+        self.drops = {} # path -> [client, octets, stored]
+        self.max_drop = max_drop
+        self.min_free = min_free
+        self.reserved = 0
+        self.root = root
+        self.shred_directory = os.path.normpath(shred_directory)
+        self.shredding = {} # claimed path -> octets
+        self.shredding_octets = 0
+        self.stored = 0
+        self._lock = thread.allocate_lock()
+        self._scan(index)
+
+    def abort(self, path):
+        """give back a failed upload's reservation"""
+        with self._lock:
+            entry = self.drops.get(path)
+
+            if entry and not entry[2]:
+                del self.drops[path]
+                self._charge(entry[0], -entry[1])
+                self.reserved -= entry[1]
+
+    def _admit(self, client, octets, size):
+        """
+        raise an HTTPError unless octets more may be reserved by client
+        for a drop of size octets
+        """
+        if not self.max_drop == None and size > self.max_drop:
+            raise baseserver.HTTPError(413, "Payload Too Large")
+        elif not self.client_quota == None \
+                and self.clients.get(client, 0) + octets > self.client_quota:
+            raise baseserver.HTTPError(507, "Insufficient Storage")
+        elif not self.capacity == None \
+                and self.usage() + octets > self.capacity:
+            raise baseserver.HTTPError(507, "Insufficient Storage")
+
+        try:
+            statvfs = os.statvfs(self.root)
+            free = statvfs.f_bavail * statvfs.f_frsize
+        except OSError:
+            free = None
+
+        if not free == None \
+                and free - self.reserved - octets < self.min_free:
+            raise baseserver.HTTPError(507, "Insufficient Storage")
+
+    def _charge(self, client, octets):
+        """adjust a client's usage"""
+        if client == None:
+            return
+        usage = self.clients.get(client, 0) + octets
+
+        if usage > 0:
+            self.clients[client] = usage
+        else:
+            self.clients.pop(client, None)
+
+    def claim(self, path, claimed):
+        """note that a stored drop was claimed for shredding"""
+        with self._lock:
+            if path in self.shredding: # moved from another shred queue
+                self.shredding[claimed] = self.shredding.pop(path)
+                return
+            entry = self.drops.pop(path, None)
+
+            if entry and entry[2]:
+                octets = entry[1]
+                self._charge(entry[0], -octets)
+                self.stored -= octets
+            else: # stored by another process, or never accounted for
+                try:
+                    octets = os.path.getsize(claimed)
+                except OSError:
+                    return
+            self.shredding[claimed] = octets
+            self.shredding_octets += octets
+
+    def commit(self, path, octets):
+        """turn an upload's reservation into a stored drop of octets"""
+        with self._lock:
+            entry = self.drops.get(path)
+
+            if not entry or entry[2]:
+                return
+            self._charge(entry[0], octets - entry[1])
+            self.reserved -= entry[1]
+            self.stored += octets
+            entry[1:] = [octets, True]
+
+    def extend(self, path, octets):
+        """
+        reserve octets more for an upload in progress
+
+        raises an HTTPError like reserve
+        """
+        with self._lock:
+            entry = self.drops.get(path)
+
+            if not entry or entry[2]:
+                return
+            self._admit(entry[0], octets, entry[1] + octets)
+            entry[1] += octets
+            self._charge(entry[0], octets)
+            self.reserved += octets
+
+    def release(self, path):
+        """forget a stored drop that was never on disk"""
+        with self._lock:
+            entry = self.drops.get(path)
+
+            if entry and entry[2]: # not a new upload to the same path
+                del self.drops[path]
+                self._charge(entry[0], -entry[1])
+                self.stored -= entry[1]
+
+    def reserve(self, path, client, octets):
+        """
+        reserve octets for an upload to path by client
+
+        raises an HTTPError when a limit would be exceeded:
+        413 for max_drop, otherwise 507
+        """
+        with self._lock:
+            self._admit(client, octets, octets)
+            self.drops[path] = [client, octets, False]
+            self._charge(client, octets)
+            self.reserved += octets
+
+    def _scan(self, index = None):
+        """account for what's already under the root"""
+        top = self.root
+
+        if not index == None:
+            for path, entry in index.entries.items():
+                self.drops[path] = [None, entry[3], True]
+                self.stored += entry[3]
+            top = self.shred_directory
+
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirpath = os.path.normpath(dirpath)
+            shredding = dirpath == self.shred_directory \
+                or dirpath.startswith(self.shred_directory + os.sep)
+
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                elif shredding:
+                    self.shredding[path] = st.st_size
+                    self.shredding_octets += st.st_size
+                else:
+                    self.drops[path] = [None, st.st_size, True]
+                    self.stored += st.st_size
+
+    def unlinked(self, path):
+        """note that a claimed drop was shredded (and unlinked)"""
+        with self._lock:
+            octets = self.shredding.pop(path, None)
+
+            if not octets == None:
+                self.shredding_octets -= octets
+
+    def usage(self):
+        """return the octets reserved, stored, or awaiting shredding"""
+        return self.reserved + self.stored + self.shredding_octets
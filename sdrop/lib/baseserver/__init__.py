@@ -18,15 +18,22 @@ __package__ = __name__
 import addr
 from addr import atos, best, stoa
 import basehttpserver
-from basehttpserver import BaseHTTPServer, GETHandler, HEADHandler, \
-    http_bufsize, HTTPConnectionHandler, HTTPHeaders, HTTPRequest, \
-    HTTPRequestEvent, HTTPRequestHandler
+from basehttpserver import Admission, Backoff, BaseHTTPServer, \
+    ChunkedReader, ChunkSizer, GETHandler, HEADHandler, http_bufsize, HTTPConfig, \
+    HTTPConnectionHandler, HTTPError, HTTPHeaders, HTTPReader, HTTPRequest, \
+    HTTPRequestEvent, HTTPRequestHandler, try_flock
 import baseserver
 from baseserver import BaseServer, SocketConfig, TCPConfig, UDPConfig
 import event
 from event import Event, ConnectionEvent, DatagramEvent, Handler, \
     IterableHandler, ServerEvent
-from lib import threaded
+import metrics
+from metrics import Counter, Exporter, Gauge, Histogram, Metrics
+import prefork
+from prefork import Prefork
+import trace
+from trace import Trace, Tracer
+from lib import polling, threaded, zerocopy
 
 __doc__ = """
 a simple event-based server framework
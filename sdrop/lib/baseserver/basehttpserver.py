@@ -13,26 +13,334 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import errno
 import fcntl
 import os
 import socket
+import string
 import sys
+import thread
+import time
 import traceback
 
 import addr
 import baseserver
 import event
+import metrics
+import trace
+from lib import polling
+from lib import zerocopy
 
 __doc__ = "a simple HTTP server"
 
-def http_bufsize(max):
-    """return the highest positive power of 2 <= max"""
-    exp = 1
-    max = min(4096, max) # keep it reasonable
+def http_bufsize(max, limit = 4096):
+    """return the highest positive power of 2 <= max (and <= limit)"""
+    exp = 0
+    max = min(limit, max) # keep it reasonable
     
     while 2 << exp <= max:
         exp += 1
-    return 2 << (exp - 1)
+    return 1 << exp
+
+class HTTPConfig(baseserver.TCPConfig):
+    """
+    configuration for an HTTP server
+
+    transfers move in chunks of BUFSIZE octets to start with;
+    when MIN_BUFSIZE < MAX_BUFSIZE, the chunk size adapts (see ChunkSizer),
+    keeping each step near STEP_TIME seconds so that one big transfer
+    can't starve the others sharing a scheduler
+
+    connections persist (HTTP/1.1 keep-alive) for up to KEEPALIVE_REQUESTS
+    requests (1 disables keep-alive), and are closed after
+    KEEPALIVE_TIMEOUT idle seconds (None for no limit) between requests;
+    each request head must also arrive in full within HEAD_TIMEOUT seconds
+    (None for no limit) of the connection being accepted,
+    or of the previous request finishing; once it has,
+    a body (or a response) that stalls for INACTIVE_TIMEOUT seconds
+    (None for no limit) ends the request, and the connection
+
+    admission limits (see Admission; None for no limit):
+        MAX_CONNECTIONS: concurrent connections
+        MAX_UPLOADS: concurrent requests with bodies
+        MAX_UPLOAD_OCTETS: octets declared by those requests
+    refused requests are answered with 503 and a Retry-After
+    of RETRY_AFTER seconds
+
+    metrics (see BaseHTTPServer.metrics) are named with METRICS_NAMESPACE
+    as a prefix, and served in the Prometheus text format
+    on METRICS_ADDRESS (None to keep them in-process);
+    under a Prefork, worker n serves its own on the port plus n
+
+    with TRACE, each request's phases are traced (see trace.Tracer):
+    requests taking at least TRACE_SLOW seconds are logged to STDERR,
+    and a TRACE_SAMPLE fraction of them is appended to TRACE_FILE
+    (if any), for a trace viewer
+    """
+    
+    BUFSIZE = 65536
+    HEAD_TIMEOUT = 10
+    INACTIVE_TIMEOUT = 30
+    KEEPALIVE_REQUESTS = 100
+    KEEPALIVE_TIMEOUT = 5
+    MAX_BUFSIZE = 4194304
+    MAX_CONNECTIONS = 1000
+    MAX_UPLOAD_OCTETS = None
+    MAX_UPLOADS = 64
+    METRICS_ADDRESS = None
+    METRICS_NAMESPACE = "baseserver"
+    MIN_BUFSIZE = 4096
+    RETRY_AFTER = 1
+    STEP_TIME = 0.005
+    TRACE = False
+    TRACE_FILE = None
+    TRACE_SAMPLE = 0.01
+    TRACE_SLOW = 1
+
+class Admission:
+    """
+    admission control: counts connections and uploads
+    (requests with bodies, and the octets they declare)
+    against the configured limits
+
+    each admission returns whether it was granted;
+    granted ones must be released later
+    """
+
+    def __init__(self, config):
+        self.connections = 0
+        self.max_connections = config.MAX_CONNECTIONS
+        self.max_upload_octets = config.MAX_UPLOAD_OCTETS
+        self.max_uploads = config.MAX_UPLOADS
+        self.rejected = 0
+        self.retry_after = config.RETRY_AFTER
+        self.upload_octets = 0
+        self.uploads = 0
+        self._lock = thread.allocate_lock()
+
+    def connect(self):
+        """admit a connection"""
+        with self._lock:
+            if not self.max_connections == None \
+                    and self.connections >= self.max_connections:
+                self.rejected += 1
+                return False
+            self.connections += 1
+            return True
+
+    def disconnect(self):
+        """release a connection"""
+        with self._lock:
+            self.connections -= 1
+
+    def error(self):
+        """return the HTTPError for a refused admission"""
+        return HTTPError(503, "Service Unavailable",
+            {"retry-after": self.retry_after})
+
+    def upload(self, octets):
+        """admit an upload of octets"""
+        with self._lock:
+            if (not self.max_uploads == None
+                        and self.uploads >= self.max_uploads) \
+                    or (not self.max_upload_octets == None
+                        and self.upload_octets + octets
+                            > self.max_upload_octets):
+                self.rejected += 1
+                return False
+            self.upload_octets += octets
+            self.uploads += 1
+            return True
+
+    def uploaded(self, octets):
+        """release an upload of octets"""
+        with self._lock:
+            self.upload_octets -= octets
+            self.uploads -= 1
+
+class Backoff:
+    """
+    space out retries: each wait doubles, from first up to cap seconds
+
+    until the first failure, there's no deadline (retry immediately)
+    """
+
+    def __init__(self, first = 0.01, cap = 0.16):
+        self.cap = cap
+        self.deadline = None # when to retry
+        self.first = first
+        self.wait = 0
+
+    def failed(self):
+        """schedule the next retry after a failed attempt"""
+        self.wait = min(self.cap, self.wait * 2 or self.first)
+        self.deadline = time.time() + self.wait
+
+class ChunkedReader:
+    """
+    decode a chunked body (RFC 7230, section 4.1) from an HTTPReader,
+    without blocking
+
+    only the size left in the current chunk is kept, so memory is bounded
+    by the reads; chunk extensions and trailers are ignored,
+    and lines longer than MAX_LINE_SIZE are refused
+    """
+
+    DATA = "data"
+    DATA_END = "data end"
+    DONE = "done"
+    MAX_LINE_SIZE = 4096
+    SIZE = "size"
+    TRAILER = "trailer"
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.remaining = 0 # in the current chunk
+        self.state = ChunkedReader.SIZE
+
+    def done(self):
+        """return whether the whole body has been read"""
+        return self.state == ChunkedReader.DONE
+
+    def ready(self):
+        """return whether recv can make progress without reading"""
+        if self.state == ChunkedReader.DATA:
+            return self.reader.buffered() > 0
+        return self.state == ChunkedReader.DONE \
+            or self.reader.line_buffered()
+
+    def recv(self, bufsize):
+        """
+        return up to bufsize octets of the body ("" once it's complete)
+
+        raises socket.timeout when nothing is ready, EOFError when
+        the connection ends first, and HTTPError (400) when it's malformed
+        """
+        while not self.state == ChunkedReader.DONE:
+            if self.state == ChunkedReader.DATA:
+                chunk = self.reader.recv(min(bufsize, self.remaining))
+
+                if not chunk:
+                    raise EOFError("connection closed within a chunk")
+                self.remaining -= len(chunk)
+
+                if not self.remaining:
+                    self.state = ChunkedReader.DATA_END
+                return chunk
+            line = self.reader.readline_nowait(self.MAX_LINE_SIZE).strip()
+
+            if self.state == ChunkedReader.DATA_END:
+                if line:
+                    raise HTTPError(400, "Bad Request")
+                self.state = ChunkedReader.SIZE
+            elif self.state == ChunkedReader.TRAILER:
+                if not line:
+                    self.state = ChunkedReader.DONE
+            else:
+                size = line.split(';', 1)[0].strip()
+
+                if not size or size.strip(string.hexdigits):
+                    raise HTTPError(400, "Bad Request")
+                self.remaining = int(size, 16)
+                self.state = ChunkedReader.DATA if self.remaining \
+                    else ChunkedReader.TRAILER
+        return ""
+
+class ChunkSizer:
+    """
+    choose chunk sizes for a transfer
+
+    the size doubles after a full chunk moves in under half of
+    STEP_TIME (a large body and a fast peer),
+    and halves after a chunk that was mostly refused (a slow peer)
+    or that overran STEP_TIME
+    """
+
+    def __init__(self, config):
+        self.max = max(config.BUFSIZE, config.MAX_BUFSIZE)
+        self.min = min(config.BUFSIZE, config.MIN_BUFSIZE)
+        self.size = config.BUFSIZE
+        self.step_time = config.STEP_TIME
+        self._requested = 0
+        self._started = None
+
+    def __call__(self, remaining):
+        """return the size of the next chunk, and start timing it"""
+        self._requested = http_bufsize(remaining, self.size)
+        self._started = time.time()
+        return self._requested
+
+    def update(self, transferred):
+        """adapt according to how much of the last chunk was transferred"""
+        if self.min == self.max or self._started == None:
+            return
+        elapsed = time.time() - self._started
+        self._started = None
+
+        if transferred >= self._requested == self.size \
+                and elapsed < self.step_time / 2:
+            self.size = min(self.max, self.size << 1)
+        elif transferred < self._requested / 2 or elapsed > self.step_time:
+            self.size = max(self.min, self.size >> 1)
+
+def _cast_numeric(value):
+    """cast a string to an int or a float, if possible"""
+    for _type in (int, float):
+        try:
+            return _type(value)
+        except ValueError:
+            pass
+    return value
+
+class HTTPError(Exception):
+    """
+    an error that maps to an HTTP response status
+    (and, optionally, headers)
+    """
+
+    def __init__(self, code = 500, message = "Internal Server Error",
+            headers = None):
+        Exception.__init__(self, code, message)
+        self.code = code
+
+        if not headers:
+            headers = {}
+        self.headers = headers
+        self.message = message
+
+def open_resource(handler, path):
+    """
+    open path for reading on behalf of a request handler,
+    and return the file, or None (having set the handler's status)
+
+    the handler's find method may rule the path out first,
+    sparing the filesystem; otherwise, the open alone decides
+    """
+    if handler.find(path):
+        try:
+            return open(path, "rb")
+        except (IOError, OSError) as e:
+            if not e.errno in (errno.EISDIR, errno.ENOENT, errno.ENOTDIR):
+                handler.code = 500
+                handler.message = "Internal Server Error"
+                return None
+    handler.code = 404
+    handler.message = "Not Found"
+    return None
+
+def try_flock(fd, operation = fcntl.LOCK_EX):
+    """
+    flock without blocking, and return whether the lock was acquired
+
+    errors other than contention are raised
+    """
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return True
+    except IOError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN, errno.EWOULDBLOCK):
+            return False
+        raise
 
 class HTTPHeaders(dict):
     """
@@ -71,31 +379,40 @@ class HTTPHeaders(dict):
         else:
             self.__setitem__(key, value)
 
-    def fload(self, fp):
-        """load from a file-like object"""
-        line = []
+    def fload(self, fp, limit = -1):
+        """
+        load from a file-like object (anything with readline)
 
-        while not "".join(line) in ("\n", "\r\n"): # read the headers
-            try:
-                line.append(fp.read(1))
-            except socket.timeout:
+        when limit is nonnegative, reading more than limit octets
+        raises an HTTPError (431)
+        """
+        pending = None # the last header, which may still be folded
+
+        while 1:
+            line = fp.readline(limit + 1 if limit > -1 else -1)
+
+            if limit > -1:
+                limit -= len(line)
+
+                if limit < 0:
+                    raise HTTPError(431, "Request Header Fields Too Large")
+
+            if not line.endswith('\n'):
+                raise EOFError("connection closed within the headers")
+            line = line.rstrip("\r\n")
+
+            if pending and line[:1] in (' ', '\t'): # obsolete line folding
+                pending[1] = ' '.join((pending[1], line.strip()))
                 continue
+            elif pending:
+                self.add(pending[0], _cast_numeric(pending[1]))
+                pending = None
 
-            if line and line[-1] == '\n':
-                if ':' in line:
-                    k, v = "".join(line).split(':', 1)
-                    v = v.strip()
-
-                    for _type in (int, float): # cast numerics
-                        try:
-                            v = _type(v)
-                            break
-                        except ValueError:
-                            pass
-                    self.add(k.strip(), v)
-                    line = []
-                elif "".join(line).rstrip("\r\n"):
-                    line = list("".join(line).strip() + ' ') # multiline
+            if not line: # end of the headers
+                return
+            elif not ':' in line:
+                raise HTTPError(400, "Bad Request")
+            pending = [e.strip() for e in line.split(':', 1)]
     
     def get(self, key, default = None):
         if not isinstance(key, str):
@@ -111,6 +428,15 @@ class HTTPHeaders(dict):
             raise KeyError("key must be a str")
         return dict.__getitem__(self, key.strip().lower())
 
+    def tokens(self, key):
+        """return a comma-separated header's values, in lowercase"""
+        value = self.get(key, "")
+
+        if isinstance(value, list):
+            value = ','.join([str(v) for v in value])
+        return [t.strip() for t in str(value).lower().split(',')
+            if t.strip()]
+
     def __setitem__(self, key, value):
         if not isinstance(key, str):
             raise KeyError("key must be a str")
@@ -132,6 +458,8 @@ class HTTPHeaders(dict):
             + ["", ""])
 
 class HTTPRequest:
+    MAX_HEADER_SIZE = 65536 # request line + headers
+
     def __init__(self, headers = None, method = None, resource = None,
             version = 0):
         if not headers:
@@ -142,110 +470,340 @@ class HTTPRequest:
         self.version = version
 
     def fload(self, fp):
-        """load from a file-like object"""
-        self.method = []
-        self.resource = []
-        self.version = []
-        
-        while not self.method or not self.method[-1] == ' ':
-            try:
-                self.method.append(fp.read(1))
-            except socket.timeout:
-                pass
-        self.method = "".join(self.method).strip()
+        """
+        load from a file-like object (anything with readline)
 
-        while not self.resource or not self.resource[-1] == ' ':
-            try:
-                self.resource.append(fp.read(1))
-            except socket.timeout:
-                pass
-        self.resource = "".join(self.resource).strip()
-        
-        while not self.version or not self.version[-1] == '\n':
+        an HTTPReader is the best choice for a socket,
+        since it reads in blocks and keeps any leftover body octets
+        """
+        limit = self.MAX_HEADER_SIZE
+        line = ""
+
+        while not line.strip(): # ignore empty lines preceding the request
+            line = fp.readline(limit + 1)
+            limit -= len(line)
+
+            if limit < 0:
+                raise HTTPError(431, "Request Header Fields Too Large")
+            elif not line.endswith('\n'):
+                raise EOFError("connection closed within the request line")
+        line = line.split()
+
+        if not len(line) == 3:
+            raise HTTPError(400, "Bad Request")
+        self.method, self.resource, version = line
+
+        try:
+            self.version = float(version[version.rfind('/') + 1:])
+        except ValueError:
+            raise HTTPError(400, "Bad Request")
+        self.headers = HTTPHeaders()
+        self.headers.fload(fp, limit)
+
+class HTTPReader:
+    """
+    a buffered reader for a connection
+
+    reads are done in large blocks, and lines are found by searching
+    the buffer (never by reading octet-by-octet);
+    whatever is read past the headers remains buffered,
+    and recv hands it out before reading from the connection again
+
+    received counts the octets read from the connection
+    """
+    
+    def __init__(self, conn, bufsize = 65536):
+        self.buffer = ""
+        self.bufsize = bufsize
+        self.conn = conn
+        self.received = 0
+        self._head_scanned = 0 # octets known to lack the end of the head
+        self._offset = 0 # start of the unconsumed data
+
+    def buffered(self):
+        """return the number of buffered (unconsumed) octets"""
+        return len(self.buffer) - self._offset
+
+    def fill(self, block = True):
+        """
+        read a block into the buffer, and return its length (0 at EOF)
+
+        when not blocking, return None if nothing could be read
+        """
+        while 1:
             try:
-                self.version.append(fp.read(1))
+                chunk = self.conn.recv(self.bufsize)
+                break
             except socket.timeout:
-                pass
-        self.version = "".join(self.version).strip()
+                if not block:
+                    return None
+        self.buffer = self.buffer[self._offset:] + chunk
+        self._offset = 0
+        self.received += len(chunk)
+        return len(chunk)
 
-        if '/' in self.version:
-            self.version = self.version[self.version.rfind('/') + 1:]
-        self.version = float(self.version)
-        self.headers = HTTPHeaders()
-        self.headers.fload(fp)
+    def head_buffered(self):
+        """
+        return whether a complete request head (request line + headers)
+        is buffered, so that parsing it won't block
+        """
+        while self.buffer.startswith('\n', self._offset) \
+                or self.buffer.startswith("\r\n", self._offset):
+            self._offset = self.buffer.find('\n', self._offset) + 1
+            self._head_scanned = 0
+        start = self._offset + max(0, self._head_scanned - 2)
+
+        for terminator in ("\n\n", "\n\r\n"):
+            if self.buffer.find(terminator, start) > -1:
+                self._head_scanned = 0
+                return True
+        self._head_scanned = self.buffered()
+        return False
+
+    def line_buffered(self):
+        """return whether a complete line is buffered"""
+        return self.buffer.find('\n', self._offset) > -1
+
+    def readline(self, size = -1):
+        """read a line (including '\n'), stopping short at size octets"""
+        scanned = 0 # octets known to lack '\n'
+
+        while 1:
+            end = self.buffer.find('\n', self._offset + scanned)
+
+            if end > -1:
+                end += 1
+                break
+            scanned = self.buffered()
+
+            if -1 < size <= scanned or not self.fill():
+                end = len(self.buffer)
+                break
+
+        if size > -1:
+            end = min(end, self._offset + size)
+        line = self.buffer[self._offset:end]
+        self._offset = end
+        return line
+
+    def readline_nowait(self, limit):
+        """
+        read a complete line (including '\n') without blocking
+
+        raises socket.timeout when it isn't all there yet, EOFError at EOF,
+        and HTTPError (400) once more than limit octets lack a '\n'
+        """
+        while 1:
+            end = self.buffer.find('\n', self._offset)
+
+            if end > -1:
+                line = self.buffer[self._offset:end + 1]
+                self._offset = end + 1
+                return line
+            elif self.buffered() > limit:
+                raise HTTPError(400, "Bad Request")
+            filled = self.fill(False)
+
+            if filled == None:
+                raise socket.timeout()
+            elif not filled:
+                raise EOFError("connection closed within a line")
+
+    def recv(self, bufsize):
+        """receive from the buffer, or from the connection when it's empty"""
+        if self.buffered():
+            chunk = self.buffer[self._offset:self._offset + bufsize]
+            self._offset += len(chunk)
+            return chunk
+        chunk = self.conn.recv(bufsize)
+        self.received += len(chunk)
+        return chunk
 
 class HTTPRequestEvent(event.ConnectionEvent):
-    def __init__(self, request, *args, **kwargs):
-        event.ConnectionEvent.__init__(self, *args, **kwargs)
+    """
+    a parsed request on a connection
+
+    request handlers should read the body through reader,
+    which may already hold part of it (and, past the body,
+    any pipelined requests)
+
+    keep_alive is whether the connection may be reused afterward
+
+    for the metrics, handlers add the octets they send to sent;
+    started is when the request head arrived, and response_started
+    when the response began
+
+    trace is the request's trace.Trace (None unless the server traces):
+    handlers record their phases in it
+    """
+    
+    def __init__(self, request, conn, remote, server, reader = None,
+            keep_alive = False):
+        event.ConnectionEvent.__init__(self, conn, remote, server)
+
+        if not reader:
+            reader = HTTPReader(conn)
+        self.keep_alive = keep_alive
+        self.response_started = None
+        self.reader = reader
         self.request = request
+        self.sent = 0
+        self.started = None
+        self.trace = None
 
 class HTTPRequestHandler(event.Handler):
+    """
+    respond with a status and headers
+
+    the connection header, as it stands once the handler finishes,
+    decides whether the connection is reused: a handler that leaves
+    the stream out of step (e.g. an unread body, or a short response)
+    must set it to "close"
+    """
+
+    CONSUMES_BODY = False # whether the whole request body is always read
+    
     def __init__(self, *args, **kwargs):
         event.Handler.__init__(self, *args, **kwargs)
+        self.active = time.time() # when octets last moved (see stalled)
         self.code = 200
         self.headers = HTTPHeaders()
         self.headers["connection"] = "close"
+
+        if self.event.keep_alive:
+            self.headers["connection"] = "keep-alive"
         self.headers["content-length"] = 0
         self.message = "OK"
 
+    def deadline(self):
+        """give up on a stalled transfer (see stalled)"""
+        timeout = self.event.server.sock_config.INACTIVE_TIMEOUT
+
+        if timeout == None:
+            return None
+        return self.active + timeout
+
+    def interest(self):
+        """wait until the response can be sent"""
+        return self.event.conn.fileno(), polling.WRITE
+
     def next(self):
         try:
             self.respond()
         except socket.error:
-            pass
+            self.headers["connection"] = "close"
         raise StopIteration()
 
     def respond(self):
         """send the appropriate headers"""
-        self.event.conn.sendall("HTTP/%.1f %u %s\r\n" % (
-            float(self.event.request.version), int(self.code),
-            str(self.message)) + str(self.headers)) # includes terminator
+        head = "HTTP/%.1f %u %s\r\n" % (float(self.event.request.version),
+            int(self.code), str(self.message)) \
+            + str(self.headers) # includes terminator
+        self.event.response_started = time.time()
+        self.event.conn.sendall(head)
+        self.event.sent += len(head)
+
+        if self.event.trace:
+            self.event.trace.span("respond", self.event.response_started)
+
+    def stalled(self):
+        """
+        return whether INACTIVE_TIMEOUT seconds have passed
+        since octets last moved (see active)
+        """
+        deadline = HTTPRequestHandler.deadline(self)
+        return not deadline == None and time.time() >= deadline
 
 class GETHandler(HTTPRequestHandler):
+    """
+    send a file
+
+    the file is sent with sendfile (zero-copy) when possible,
+    falling back to read/send; either way, partial sends
+    are resumed from the right offset, and a peer that stops reading
+    is given up on once the transfer stalls (see stalled)
+    """
+    
     def __init__(self, *args, **kwargs):
         HTTPRequestHandler.__init__(self, *args, **kwargs)
+        self.chunk_sizer = ChunkSizer(self.event.server.sock_config)
         self.content_length = -1
         self.fp = None
+        self.lock_retry = Backoff()
+        self.lock_wait = None # when the lock was first tried (if tracing)
         self.locked = False
+        self.offset = 0
         self.path = self.event.server.resolve(self.event.request.resource)
-        
-        if os.path.exists(self.path) and not os.path.isdir(self.path):
-            try:
-                self.fp = open(self.path, "rb")
-                self.fp.seek(0, os.SEEK_END)
-                self.content_length = self.fp.tell()
-                self.headers["content-length"] = self.content_length
-                self.fp.seek(0, os.SEEK_SET)
-            except (IOError, OSError):
-                self.code = 500
-                self.message = "Internal Server Error"
-        else:
-            self.code = 404
-            self.message = "Not Found"
-        
-        if self.fp: # path is inherently nonexistent
-            try:
-                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
-                self.locked = True
-            except IOError:
-                self.code = 500
-                self.message = "Internal Server Error"
+        self.responded = False
+        self.zerocopy = bool(zerocopy.sendfile)
+        self.fp = open_resource(self, self.path)
 
-        try:
-            HTTPRequestHandler.respond(self) # send response header
-        except socket.error: # the file will eventually be closed
-            self.locked = False
+    def deadline(self):
+        if self.fp and not self.responded: # retrying the lock
+            return self.lock_retry.deadline
+        return HTTPRequestHandler.deadline(self)
+
+    def find(self, path):
+        """return whether path may name a file (if not, it isn't opened)"""
+        return True
+
+    def interest(self):
+        if self.fp and not self.responded and self.lock_retry.deadline:
+            return self.event.conn.fileno(), 0 # retry at the deadline
+        return HTTPRequestHandler.interest(self)
 
     def next(self):
+        trace = self.event.trace
+
+        if not self.responded:
+            if self.fp: # path is inherently nonexistent
+                if trace and self.lock_wait == None:
+                    self.lock_wait = time.time()
+
+                try:
+                    if not try_flock(self.fp.fileno()): # try again later
+                        self.lock_retry.failed()
+                        return
+                    self.locked = True
+
+                    if trace:
+                        trace.span("lock", self.lock_wait)
+                    self.opened()
+                except (IOError, OSError):
+                    self.code = 500
+                    self.message = "Internal Server Error"
+            self.responded = True
+
+            try:
+                HTTPRequestHandler.respond(self) # send response header
+                self.active = time.time()
+            except socket.error: # the file will eventually be closed
+                self.headers["connection"] = "close"
+                self.locked = False
+            return
+        
         if self.locked:
-            if self.content_length: # fp is inherently open
+            if self.content_length > 0: # fp is inherently open
                 try:
-                    chunk = self.fp.read(http_bufsize(self.content_length))
-                    self.content_length -= len(chunk)
-                    self.event.conn.sendall(chunk)
-                except IOError:
-                    pass
-                return
+                    sent = self.send()
+                except socket.timeout: # the socket buffer is full
+                    if not self.stalled():
+                        return
+                    sent = 0
+                except (IOError, OSError) as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) \
+                            and not self.stalled():
+                        return
+                    sent = 0
+
+                if sent:
+                    self.active = time.time()
+                    self.content_length -= sent
+                    self.event.sent += sent
+                    self.offset += sent
+                    return
+                self.content_length = 0 # truncated, or the peer is gone
+                self.headers["connection"] = "close"
             
             try:
                 fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
@@ -261,25 +819,89 @@ class GETHandler(HTTPRequestHandler):
             self.fp = None
         raise StopIteration()
 
+    def opened(self):
+        """called once the file is locked: prepare the response"""
+        self.content_length = os.fstat(self.fp.fileno()).st_size
+        self.headers["content-length"] = self.content_length
+
+    def send(self):
+        """send part of the file from offset, and return the amount sent"""
+        size = self.chunk_sizer(self.content_length)
+        trace = self.event.trace
+        started = time.time() if trace else None
+
+        if self.zerocopy:
+            try: # the socket is nonblocking, so this sends what fits
+                sent = zerocopy.sendfile(self.event.conn.fileno(),
+                    self.fp.fileno(), self.offset, size)
+                self.chunk_sizer.update(sent)
+
+                if trace:
+                    trace.span("sendfile", started)
+                return sent
+            except OSError as e:
+                if not e.errno in zerocopy.UNSUPPORTED:
+                    raise
+                self.zerocopy = False
+        self.fp.seek(self.offset, os.SEEK_SET)
+        data = self.fp.read(size)
+
+        if trace:
+            read = time.time()
+            trace.span("read", started, read)
+        sent = self.event.conn.send(data)
+        self.chunk_sizer.update(sent)
+
+        if trace:
+            trace.span("send", read)
+        return sent
+
 class HEADHandler(HTTPRequestHandler):
+    """report a file's size, once any writer has released it"""
+
+    def __init__(self, *args, **kwargs):
+        HTTPRequestHandler.__init__(self, *args, **kwargs)
+        self.lock_retry = Backoff()
+        self.path = self.event.server.resolve(self.event.request.resource)
+        self.fp = open_resource(self, self.path)
+
+    def deadline(self):
+        if self.fp: # retrying the lock
+            return self.lock_retry.deadline
+        return HTTPRequestHandler.deadline(self)
+
+    def find(self, path):
+        """return whether path may name a file (if not, it isn't opened)"""
+        return True
+
+    def interest(self):
+        if self.fp and self.lock_retry.deadline:
+            return self.event.conn.fileno(), 0 # retry at the deadline
+        return HTTPRequestHandler.interest(self)
+
     def next(self):
-        path = self.event.server.resolve(self.event.request.resource)
-        
-        if os.path.exists(path) and not os.path.isdir(path):
+        if self.fp:
             try:
-                with open(path, "rb") as fp:
-                    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
-                    fp.seek(0, os.SEEK_END)
-                    self.headers["content-length"] = fp.tell()
-                    fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+                if not try_flock(self.fp.fileno()): # try again later
+                    self.lock_retry.failed()
+                    return
+                self.headers["content-length"] = self.size()
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
             except (IOError, OSError):
                 self.code = 500
                 self.message = "Internal Server Error"
-        else:
-            self.code = 404
-            self.message = "Not Found"
+
+            try:
+                self.fp.close()
+            except (IOError, OSError):
+                pass
+            self.fp = None
         HTTPRequestHandler.next(self) # respond/stop
 
+    def size(self):
+        """return the size to report (called once the file is locked)"""
+        return os.fstat(self.fp.fileno()).st_size
+
 class HTTPConnectionHandler(event.Handler):
     """
     parse an HTTP header and execute the appropriate handler
@@ -288,47 +910,157 @@ class HTTPConnectionHandler(event.Handler):
 
     this class is intended to be used as a template for handling
     different types of requests
+
+    no step blocks: the request head is read as it arrives
+    (see interest), so a slow client only costs a socket,
+    and only until the head times out (see deadline)
+
+    connections persist between requests when both sides agree
+    (see keep_alive), and pipelined requests are parsed from
+    whatever the reader holds past the previous one
+
+    connections and uploads beyond the server's admission limits
+    are answered with 503 as soon as their request head is parsed
+    (before any body is read)
+
+    each finished request is recorded in the server's metrics,
+    and traced when the server traces: from the first octets of its head
+    (or for a connection's first request, from when it was accepted,
+    counting the wait for the scheduler as "queued")
     """
     
     METHOD_TO_HANDLER = {"GET": GETHandler, "HEAD": HEADHandler}
     
     def __init__(self, *args, **kwargs):
         event.Handler.__init__(self, *args, **kwargs)
-        request = HTTPRequest()
-        request_event = HTTPRequestEvent(request, self.event.conn,
-            self.event.remote, self.event.server)
         self.address_string = addr.atos(self.event.remote)
+        self.admitted = self.event.server.admission.connect()
+        self.head_started = None # when tracing
+        self.idle_since = time.time()
+        self.accepted = self.idle_since # (for the first request's trace)
+        self.first_step = None
+        self.received = 0 # octets recorded in the metrics
+        self.upload = None # the admitted upload's octets
+        self.request_event = HTTPRequestEvent(HTTPRequest(), self.event.conn,
+            self.event.remote, self.event.server)
         self.request_handler = None
-        
+        self.requests = 0 # parsed on this connection
+
         try:
             self.event.conn.settimeout(self.event.server.sock_config.TIMEOUT)
-            request.fload(self.event.conn.makefile())
-            request.method = request.method.upper()
-            
-            self.event.server.sprint(self.event.server.PREFIX, "Handling",
-                request.method, "request for",
-                self.event.server.resolve(request.resource), "from",
-                self.address_string)
-            
-            if not request.method in HTTPConnectionHandler.METHOD_TO_HANDLER:
-                # response will be sent on first call to next
-                self.request_handler.code = 501
-                self.request_handler.status = "Not Supported"
-            self.request_handler = HTTPConnectionHandler.METHOD_TO_HANDLER.get(
-                request.method, HTTPRequestHandler)(request_event).__iter__()
-        except Exception:
-            self.event.server.sprinte(self.event.server.ERROR_PREFIX,
-                "Handling connection with %s:\n"
-                    % self.address_string, traceback.format_exc())
-            self.request_handler = None
+        except socket.error:
+            pass
+
+        # a response's head and body are separate writes:
+        # don't let Nagle hold the body until the head is ACKed
+        try:
+            self.event.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                1)
+        except socket.error:
+            pass
+
+    def admit(self, handler_class):
+        """
+        raise an HTTPError (503) unless the connection, and the request
+        (if handler_class reads its body), may proceed
+        """
+        admission = self.event.server.admission
+        headers = self.request_event.request.headers
+
+        if not self.admitted:
+            raise admission.error()
+        elif not handler_class.CONSUMES_BODY \
+                or not (headers.get("content-length", 0)
+                    or headers.has_key("transfer-encoding")):
+            return
+        octets = headers.get("content-length", 0)
+
+        if not isinstance(octets, (int, long)) or octets < 0:
+            octets = 0 # the handler will object
+
+        if not admission.upload(octets):
+            raise admission.error()
+        self.upload = octets
+
+    def deadline(self):
+        """
+        close a connection that's waited too long for a request head
+        (HEAD_TIMEOUT, or between requests, KEEPALIVE_TIMEOUT if it's shorter);
+        otherwise, defer to the request handler
+        """
+        config = self.event.server.sock_config
+        timeouts = [t for t in (config.HEAD_TIMEOUT,
+            config.KEEPALIVE_TIMEOUT if self.requests else None)
+                if not t == None]
+
+        if self.request_handler:
+            return self.request_handler.deadline()
+        elif not timeouts:
+            return None
+        return self.idle_since + min(timeouts)
+
+    def idle(self):
+        """
+        return whether the connection has waited too long
+        for a request head (see deadline)
+        """
+        deadline = self.deadline()
+        return not deadline == None and time.time() >= deadline \
+            and not self.request_event.reader.head_buffered()
+
+    def interest(self):
+        """wait for the request head, then delegate to the request handler"""
+        if not self.event.server.alive.get():
+            return None
+        elif self.request_handler:
+            return self.request_handler.interest()
+        elif self.request_event.reader.head_buffered() or self.idle():
+            return None
+        return self.event.conn.fileno(), polling.READ
+
+    def keep_alive(self, handler_class):
+        """
+        return whether the connection may persist after the current request,
+        which is to be handled by handler_class
+        """
+        config = self.event.server.sock_config
+        request = self.request_event.request
+        tokens = request.headers.tokens("connection")
+
+        if not self.event.server.alive.get() \
+                or self.requests >= config.KEEPALIVE_REQUESTS \
+                or "close" in tokens:
+            return False
+        elif request.version < 1.1 and not "keep-alive" in tokens:
+            return False
+        elif request.headers.get("content-length", 0) \
+                or request.headers.has_key("transfer-encoding"):
+            return handler_class.CONSUMES_BODY # otherwise, it's left unread
+        return True
     
     def next(self):
+        if self.event.server.alive.get() and not self.request_handler \
+                and not self.idle():
+            try:
+                if not self.parse(): # wait for the rest of the head
+                    return
+            except EOFError: # the client hung up
+                pass
+            except Exception:
+                self.event.server.sprinte(self.event.server.ERROR_PREFIX,
+                    "Handling connection with %s:\n"
+                        % self.address_string, traceback.format_exc())
+            
+            if self.request_handler: # respond on the next step
+                return
+        
         if self.event.server.alive.get() and self.request_handler: # delegate
             try:
                 return self.request_handler.next()
             except StopIteration:
                 pass
             except Exception:
+                self.request_handler.headers["connection"] = "close"
                 self.event.server.sprinte(self.event.server.ERROR_PREFIX,
                     "Handling connection with %s:\n"
                         % self.address_string, traceback.format_exc())
@@ -338,9 +1070,29 @@ class HTTPConnectionHandler(event.Handler):
                 "Connection with", self.address_string, "resulted in status:",
                 self.request_handler.code,
                 "(%s)" % self.request_handler.message)
+
+            self.record()
+            self.release_upload()
+
+            if self.event.server.alive.get() and str(
+                    self.request_handler.headers.get("connection")
+                    ).lower() == "keep-alive": # wait for the next request
+                self.idle_since = time.time()
+                self.request_event = HTTPRequestEvent(HTTPRequest(),
+                    self.event.conn, self.event.remote, self.event.server,
+                    self.request_event.reader)
+                self.request_handler = None
+                return
         self.event.server.sprint(self.event.server.PREFIX,
             "Closing connection with", self.address_string)
         
+        self.record_received()
+        self.release_upload()
+
+        if self.admitted: # before the peer can see the connection close
+            self.event.server.admission.disconnect()
+            self.admitted = False
+
         try:
             self.event.conn.shutdown(socket.SHUT_RDWR)
         except socket.error:
@@ -349,6 +1101,143 @@ class HTTPConnectionHandler(event.Handler):
         self.request_handler = None
         raise StopIteration()
 
+    def record(self):
+        """record the finished request in the server's metrics"""
+        registry = self.event.server.metrics
+        method = self.request_event.request.method
+        started = self.request_event.started
+
+        if not method in HTTPConnectionHandler.METHOD_TO_HANDLER:
+            method = "other" # so the labels stay bounded
+        registry["requests_total"].inc(1, (method,
+            self.request_handler.code))
+        registry["sent_bytes_total"].inc(self.request_event.sent)
+
+        if self.request_event.trace:
+            self.event.server.tracer.finish(self.request_event.trace,
+                "%s %s" % (self.request_event.request.method,
+                    self.request_event.request.resource),
+                {"code": self.request_handler.code,
+                    "remote": self.address_string})
+
+        if started:
+            registry["request_duration_seconds"].observe(
+                time.time() - started, (method, ))
+
+            if self.request_event.response_started:
+                registry["time_to_first_byte_seconds"].observe(
+                    self.request_event.response_started - started,
+                    (method, ))
+        self.record_received()
+
+    def record_received(self):
+        """record the octets received since the last time"""
+        received = self.request_event.reader.received
+
+        if received > self.received:
+            self.event.server.metrics["received_bytes_total"].inc(
+                received - self.received)
+            self.received = received
+
+    def release_upload(self):
+        """release the current request's upload admission, if any"""
+        if not self.upload == None:
+            self.event.server.admission.uploaded(self.upload)
+            self.upload = None
+
+    def parse(self):
+        """
+        read what's available of the request head,
+        and return whether the request handler is ready
+        """
+        reader = self.request_event.reader
+        request = self.request_event.request
+        tracer = self.event.server.tracer
+
+        if tracer:
+            if self.first_step == None:
+                self.first_step = time.time()
+
+            if self.head_started == None and reader.buffered(): # pipelined
+                self.head_started = time.time()
+
+        while not reader.head_buffered():
+            if reader.buffered() > request.MAX_HEADER_SIZE:
+                break # let fload raise the error
+            filled = reader.fill(False)
+
+            if filled == None: # nothing more yet
+                return False
+            elif not filled:
+                raise EOFError("connection closed within the request head")
+            elif tracer and self.head_started == None:
+                self.head_started = time.time()
+        self.request_event.started = time.time()
+
+        if tracer:
+            self.request_event.trace = self.trace(tracer)
+        
+        try: # request handlers may also reject the request
+            request.fload(reader)
+
+            if self.request_event.trace:
+                self.request_event.trace.span("parse",
+                    self.request_event.started)
+            request.method = request.method.upper()
+            self.requests += 1
+            
+            self.event.server.sprint(self.event.server.PREFIX, "Handling",
+                request.method, "request for",
+                self.event.server.resolve(request.resource), "from",
+                self.address_string)
+            handler_class = HTTPConnectionHandler.METHOD_TO_HANDLER.get(
+                request.method, HTTPRequestHandler)
+            self.admit(handler_class)
+            self.request_event.keep_alive = self.keep_alive(handler_class)
+            started = time.time()
+            self.request_handler = handler_class(self.request_event
+                ).__iter__()
+
+            if self.request_event.trace:
+                self.request_event.trace.span("setup", started)
+        except HTTPError as e: # respond with the error
+            self.event.server.sprinte(self.event.server.ERROR_PREFIX,
+                "Rejected request from", self.address_string,
+                "(%s)" % e.message)
+
+            if not request.version:
+                request.version = 1.0
+            self.request_event.keep_alive = False # the stream may be garbled
+            self.request_handler = HTTPRequestHandler(self.request_event)
+
+            for k, v in e.headers.items():
+                self.request_handler.headers[k] = v
+            self.request_handler.code = e.code
+            self.request_handler.message = e.message
+            return True
+        
+        if not request.method in HTTPConnectionHandler.METHOD_TO_HANDLER:
+            # response will be sent on first call to next
+            self.request_handler.code = 501
+            self.request_handler.message = "Not Implemented"
+        return True
+
+    def trace(self, tracer):
+        """start the trace of a request whose head just arrived"""
+        started = self.request_event.started
+        head_started = self.head_started or started
+        self.head_started = None
+
+        if self.accepted == None:
+            _trace = tracer.trace(head_started)
+        else: # the connection's first request
+            _trace = tracer.trace(self.accepted)
+            _trace.span("queued", self.accepted, self.first_step)
+            head_started = max(head_started, self.first_step)
+            self.accepted = None
+        _trace.span("head", head_started, started)
+        return _trace
+
 class BaseHTTPServer(baseserver.BaseServer):
     """
     a simple HTTP server
@@ -359,13 +1248,61 @@ class BaseHTTPServer(baseserver.BaseServer):
 
     requests are parsed and processed in the handler,
     leaving the event loop nice and (relatively) tight
+
+    metrics (a metrics.Metrics) holds the requests by method and status,
+    their latency (to the first octet of the response, and to its end),
+    the octets received and sent, and the admission and scheduler
+    statistics; they're served by exporter (see metrics.Exporter)
+    when METRICS_ADDRESS is set, and are per process:
+    a server that's worker n of a Prefork (given as the worker keyword)
+    serves them on METRICS_ADDRESS's port plus n,
+    so each worker is scraped (and its counters kept) separately
     """
     
     def __init__(self, handler_class = HTTPConnectionHandler, isolate = True,
-            root = os.getcwd(), sock_config = baseserver.TCPConfig(), *args,
-            **kwargs):
+            root = os.getcwd(), sock_config = HTTPConfig, *args, **kwargs):
+        if not isinstance(sock_config(), HTTPConfig):
+            raise TypeError("sock_config must inherit from HTTPConfig")
+        self.worker = kwargs.pop("worker", 0)
         baseserver.BaseServer.__init__(self, event.ConnectionEvent,
             handler_class, sock_config, *args, **kwargs)
+        self.admission = Admission(sock_config)
+        self.metrics = metrics.Metrics(sock_config.METRICS_NAMESPACE)
+        self.metrics.counter("requests_total", "requests handled",
+            ("method", "code"))
+        self.metrics.histogram("request_duration_seconds",
+            "seconds from a request head's arrival to the response's end",
+            ("method", ))
+        self.metrics.histogram("time_to_first_byte_seconds",
+            "seconds from a request head's arrival to the response's start",
+            ("method", ))
+        self.metrics.counter("received_bytes_total",
+            "octets received from clients")
+        self.metrics.counter("sent_bytes_total", "octets sent to clients")
+        self.metrics.gauge("connections", "admitted connections",
+            lambda: self.admission.connections)
+        self.metrics.gauge("uploads", "admitted uploads",
+            lambda: self.admission.uploads)
+        self.metrics.gauge("admission_rejected_total",
+            "connections and uploads refused by admission control",
+            lambda: self.admission.rejected, type = "counter")
+        self.metrics.gauge("scheduler", "the task scheduler's statistics",
+            self._scheduler_stats, ("stat", ))
+        self.exporter = None
+        self.tracer = None
+
+        if sock_config.TRACE:
+            self.tracer = trace.Tracer(sock_config.TRACE_SLOW,
+                sock_config.TRACE_SAMPLE, sock_config.TRACE_FILE,
+                lambda line: self.sprinte(line))
+
+        if sock_config.METRICS_ADDRESS:
+            address = tuple(sock_config.METRICS_ADDRESS)
+
+            if address[1]: # (an ephemeral port needs no offset)
+                address = address[:1] + (address[1] + self.worker, ) \
+                    + address[2:]
+            self.exporter = metrics.Exporter(self.metrics, address)
         resolve = lambda r: r
         
         if isolate:
@@ -376,5 +1313,21 @@ class BaseHTTPServer(baseserver.BaseServer):
         if not os.path.exists(self.root):
             os.makedirs(self.root)
 
+    def cleanup(self):
+        baseserver.BaseServer.cleanup(self)
+
+        if self.exporter:
+            self.exporter.kill()
+
+        if self.tracer:
+            self.tracer.close()
+
+    def _scheduler_stats(self):
+        """return the scheduler's numeric statistics, by name"""
+        if not hasattr(self, "_threaded"):
+            return {}
+        return dict(((k, ), v) for k, v
+            in getattr(self, "_threaded").stats().items() if not v == None)
+
 if __name__ == "__main__":
     BaseHTTPServer()()
@@ -16,11 +16,11 @@
 import socket
 import sys
 import thread
-import time
 import traceback
 
 import addr
 import event
+from lib import polling
 from lib import threaded
 
 __doc__ = "an extensible socket server implementation"
@@ -32,7 +32,6 @@ class SocketConfig:
     GENERATING_ATTR = None
     GENERATING_ATTR_ARGS = ()
     GENERATING_ATTR_KWARGS = {}
-    SLEEP = 0.001
     TIMEOUT = 0.001
     TYPE = socket.SOCK_RAW
 
@@ -40,7 +39,6 @@ class TCPConfig(SocketConfig):
     BACKLOG = 100
     GENERATING_ATTR = "accept"
     INACTIVE_TIMEOUT = None # guideline for handlers
-    SLEEP = 0.01
     TYPE = socket.SOCK_STREAM
 
 class UDPConfig(SocketConfig):
@@ -58,6 +56,9 @@ class BaseServer:
     if threaded, the server passes the handler
     to the task scheduler (a threaded.Threaded instance),
     which in turn executes the task
+
+    events are only generated once the socket is ready
+    (see polling.Poller), so an idle server sleeps in the kernel
     """
 
     ERROR_PREFIX = "[!]"
@@ -78,6 +79,7 @@ class BaseServer:
         self.event_class = event_class
         self.handler_class = handler_class
         self.sock_config = sock_config
+        self._poller = polling.Poller()
         self._print_lock = thread.allocate_lock()
         
         self._sock = socket.socket(af, sock_config.TYPE)
@@ -90,6 +92,7 @@ class BaseServer:
         self._sock.bind(self.sock_config.ADDRESS)
         
         self.sock_config.ADDRESS = self._sock.getsockname() # update
+        self._poller.register(self._sock, polling.READ)
         self.stderr = stderr
         self.stdout = stdout
 
@@ -144,6 +147,7 @@ class BaseServer:
         except socket.error:
             pass
         self._sock.close()
+        self._poller.close()
     
     def __iter__(self):
         return self
@@ -151,6 +155,7 @@ class BaseServer:
     def kill(self):
         """signal a graceful exit"""
         self.alive.set(False)
+        self._poller.wakeup()
 
     def next(self):
         """generate an event"""
@@ -158,13 +163,15 @@ class BaseServer:
             raise StopIteration()
         
         while self.alive.get():
+            if not self._poller.poll(): # woken up
+                continue
+            
             try:
                 _event = getattr(self._sock,
                     self.sock_config.GENERATING_ATTR)(
                         *self.sock_config.GENERATING_ATTR_ARGS,
                         **self.sock_config.GENERATING_ATTR_KWARGS)
-            except socket.timeout:
-                time.sleep(self.sock_config.SLEEP)
+            except socket.timeout: # another process beat us to it
                 continue
             
             if self.event_class:
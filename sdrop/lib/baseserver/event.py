@@ -13,6 +13,8 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+
 import addr
 from lib import threaded
 
@@ -32,6 +34,41 @@ class IterableHandler(threaded.IterableTask):
         threaded.IterableTask.__init__(self)
         self.event = event
 
+    def __call__(self):
+        """
+        execute the entire handler (as blocking schedulers do),
+        sleeping through waits on nothing but the deadline
+        """
+        for part in self:
+            interest = self.interest()
+
+            if interest and not interest[1]:
+                deadline = self.deadline()
+
+                if not deadline == None:
+                    time.sleep(max(0, deadline - time.time()))
+
+    def interest(self):
+        """
+        return the (fd, events) the next step waits on,
+        or None if it may run immediately
+
+        events is a mask of polling.READ and polling.WRITE;
+        readiness-aware schedulers (e.g. threaded.Multiplexing)
+        only step the handler once the I/O is ready
+        (with no events, only once the deadline passes)
+        """
+        return None
+
+    def deadline(self):
+        """
+        return when (as a time.time() value) the next step should run
+        even if the I/O it waits on never becomes ready, or None
+
+        this is how handlers time out while waiting
+        """
+        return None
+
 Handler = IterableHandler
 
 class ServerEvent(Event):
@@ -0,0 +1,158 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import errno
+import fcntl
+import os
+import select
+
+__doc__ = "I/O readiness polling"
+
+READ = select.POLLIN
+WRITE = select.POLLOUT
+
+class Poller:
+    """
+    wait for file descriptors to become ready
+
+    uses the best available mechanism (epoll, then poll, then select);
+    events are masks of READ and WRITE, and errors/hangups are reported
+    as both (so the waiting party finds out on its next operation)
+
+    only wakeup is safe to call from another thread
+    """
+
+    def __init__(self):
+        self._fds = {} # fd -> events
+        self.mechanism = "select"
+
+        if hasattr(select, "epoll"):
+            self.mechanism = "epoll"
+            self._poll = select.epoll()
+        elif hasattr(select, "poll"):
+            self.mechanism = "poll"
+            self._poll = select.poll()
+        self._wakeup_fds = os.pipe()
+
+        for fd in self._wakeup_fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.register(self._wakeup_fds[0], READ)
+
+    def close(self):
+        """release the underlying resources"""
+        if not self.mechanism == "select":
+            getattr(self._poll, "close", lambda: None)()
+
+        for fd in self._wakeup_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._fds = {}
+
+    def __contains__(self, fd):
+        return fd in self._fds
+
+    def poll(self, timeout = None):
+        """
+        wait up to timeout seconds (forever if None)
+        and return a list of (fd, events) pairs
+
+        returns early (possibly with an empty list) after a wakeup
+        """
+        try:
+            if self.mechanism == "epoll":
+                if timeout == None:
+                    timeout = -1
+                ready = self._poll.poll(timeout)
+            elif self.mechanism == "poll":
+                if not timeout == None:
+                    timeout = int(timeout * 1000)
+                ready = self._poll.poll(timeout)
+            else:
+                r, w, x = select.select(
+                    [fd for fd, e in self._fds.items() if e & READ],
+                    [fd for fd, e in self._fds.items() if e & WRITE],
+                    [fd for fd, e in self._fds.items() if e], timeout)
+                ready = {}
+
+                for events, fds in ((READ, r), (WRITE, w),
+                        (READ | WRITE, x)):
+                    for fd in fds:
+                        ready[fd] = ready.get(fd, 0) | events
+                ready = ready.items()
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        events = []
+
+        for fd, _events in ready:
+            if fd == self._wakeup_fds[0]:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            elif _events & ~(READ | WRITE): # error or hangup
+                _events = READ | WRITE
+            events.append((fd, _events & (READ | WRITE)))
+        return events
+
+    def register(self, fd, events):
+        """
+        watch fd for events, replacing any previous registration
+
+        with no events, fd isn't watched at all (not even for errors)
+        """
+        if hasattr(fd, "fileno"):
+            fd = fd.fileno()
+
+        if not events:
+            self.unregister(fd)
+        elif self.mechanism == "epoll":
+            try:
+                self._poll.modify(fd, events)
+            except IOError as e: # not registered (or closed and reused)
+                if not e.errno == errno.ENOENT:
+                    raise
+                self._poll.register(fd, events)
+        elif self.mechanism == "poll":
+            self._poll.register(fd, events) # also modifies
+        self._fds[fd] = events
+
+    def unregister(self, fd):
+        """stop watching fd (closed descriptors are tolerated)"""
+        if hasattr(fd, "fileno"):
+            fd = fd.fileno()
+
+        if not fd in self._fds:
+            return
+        del self._fds[fd]
+
+        if not self.mechanism == "select":
+            try:
+                self._poll.unregister(fd)
+            except (IOError, KeyError, OSError, ValueError):
+                pass
+
+    def wakeup(self):
+        """interrupt a blocking poll (thread-safe)"""
+        try:
+            os.write(self._wakeup_fds[1], '\0')
+        except OSError: # full (a wakeup is already pending) or closed
+            pass
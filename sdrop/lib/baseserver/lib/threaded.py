@@ -13,10 +13,14 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import heapq
 import Queue
 import thread
+import threading
 import time
 
+import polling
+
 __doc__ = "threaded multitasking"
 
 class Synchronized:
@@ -147,38 +151,106 @@ class Threaded:
         """allocate space for a task, optionally with arguments"""
         raise NotImplementedError()
 
+    def stats(self):
+        """
+        return a dictionary of statistics:
+            active: the number of tasks executing
+            queued: the number of tasks waiting for a thread
+            utilization: active / nthreads (None when unbounded)
+        """
+        active = self.nactive.get()
+        queued = 0
+        utilization = None
+
+        if hasattr(self, "_input_queue"):
+            queued = getattr(self, "_input_queue").qsize()
+
+        if self.nthreads > 0:
+            utilization = float(active) / self.nthreads
+        return {"active": active, "queued": queued,
+            "utilization": utilization}
+
 class Blocking(Threaded):
-    """block until a task can be executed"""
+    """
+    block until a task can be executed
+
+    with a positive nthreads, tasks run on up to nthreads persistent
+    workers (started as they're needed), and put waits
+    (without spinning) until one is free
+    """
 
     def __init__(self, *args, **kwargs):
         Threaded.__init__(self, *args, **kwargs)
-        self._allocation_lock = thread.allocate_lock()
+        self.alive = Synchronized(True)
+        self._admitted = 0 # queued or executing on a worker
+        self._input_queue = Queue.Queue()
+        self._nworkers = 0
+        self._slots = None
+        self._workers_lock = thread.allocate_lock()
+
+        if self.nthreads > 0:
+            self._slots = threading.Semaphore(self.nthreads)
+
+    def kill_all(self):
+        """stop the workers once they finish their current tasks"""
+        self.alive.set(False)
+
+        with self._workers_lock:
+            for i in range(self._nworkers):
+                self._input_queue.put(None)
 
     def put(self, task, *args, **kwargs):
         """block until the task can be executed"""
         if self.nthreads == 0:
             self._handle_task(task, *args, **kwargs)
-        else:
-            if self.nthreads > 0: # block
-                while 1: # allocate a thread
-                    try:
-                        self._allocation_lock.acquire()
-
-                        if self.nactive.get() < self.nthreads:
-                            self.nactive.transform(lambda n: n + 1)
-                            break # releases lock
-                    finally:
-                        self._allocation_lock.release()
-                    time.sleep(0.001) # since we're blocking, decrease usage
+            return
+        elif self.nthreads < 0:
+            self.nactive.transform(lambda n: n + 1)
             thread.start_new_thread(self._handle_task,
                 tuple([task] + list(args)), kwargs)
+            return
+        self._slots.acquire() # block until a worker is free
+
+        with self._workers_lock:
+            self._admitted += 1
+
+            if self._nworkers < self._admitted: # all are busy
+                self._nworkers += 1
+                thread.start_new_thread(self._worker_loop, ())
+        self._input_queue.put(TaskInfo(task, None, *args, **kwargs))
+
+    def _worker_loop(self):
+        """handle tasks as they appear"""
+        while 1:
+            taskinfo = self._input_queue.get()
+
+            if taskinfo == None:
+                break
+            self.nactive.transform(lambda n: n + 1)
+
+            try:
+                self._handle_task(taskinfo.task, *taskinfo.args,
+                    **taskinfo.kwargs)
+            finally:
+                with self._workers_lock:
+                    self._admitted -= 1
+                self._slots.release()
+
+        with self._workers_lock:
+            self._nworkers -= 1
+
+    def stats(self):
+        stats = Threaded.stats(self)
+        stats["workers"] = self._nworkers
+        return stats
 
 class Slaving(Threaded):
     """
     handle tasks among a finite (positive) number of slaves
 
     because threads are tough to kill,
-    the only option is a graceful exit (use kill_all)
+    the only option is a graceful exit (use kill_all):
+    each slave exits once it finishes its current task
     """
 
     def __init__(self, nthreads = 1, *args, **kwargs):
@@ -192,9 +264,12 @@ class Slaving(Threaded):
         self.start() # starts the slaves
 
     def kill_all(self):
-        """attempt to gracefully kill the slaves"""
+        """attempt to gracefully kill the slaves (waking idle ones)"""
         self.alive.set(False)
 
+        for i in range(self.nthreads):
+            self._input_queue.put(None)
+
     def put(self, task, *args, **kwargs):
         """queue a task for execution"""
         self._input_queue.put(TaskInfo(task, None, *args, **kwargs))
@@ -203,6 +278,10 @@ class Slaving(Threaded):
         """handle tasks as they appear"""
         while self.alive.get():
             taskinfo = self._input_queue.get()
+
+            if taskinfo == None: # see kill_all
+                break
+            self.nactive.transform(lambda n: n + 1)
             self._handle_task(taskinfo.task, *taskinfo.args, **taskinfo.kwargs)
 
     def start(self):
@@ -215,22 +294,251 @@ class Slaving(Threaded):
             i += 1
 
 class Pipelining(Slaving):
-    """pipeline iterable tasks among the slaves"""
+    """
+    pipeline iterable tasks among the slaves
+
+    as with Multiplexing, a task may declare what its next step waits on
+    (interest) and when to step it regardless (deadline):
+    waiting tasks are parked in a poller, watched by a separate thread,
+    so the slaves only ever step tasks that are ready
+    """
 
     def __init__(self, nthreads = 1):
+        self._deadlines = [] # heap of (deadline, id(task), task)
+        self._fds = {} # parked task -> fd
+        self._parked = [] # (task, interest) pairs to register
+        self._parked_lock = thread.allocate_lock()
+        self._poller = polling.Poller()
+        self._waiting = {} # fd -> task
         Slaving.__init__(self, nthreads)
         self._handle_task = self._handle_iterable_task
+        thread.start_new_thread(self._poll_loop, ())
+
+    def _dispatch(self, fd):
+        """queue the task waiting on fd"""
+        self._poller.unregister(fd)
+        task = self._waiting.pop(fd)
+        self._fds.pop(task, None)
+        self._input_queue.put(TaskInfo(task, None))
 
     def _handle_iterable_task(self, iterable_task):
-        """execute the task and enqueue any remaining steps"""
+        """execute the task, then queue or park any remaining steps"""
         try:
             iterable_task.next()
-            self._input_queue.put(TaskInfo(iterable_task, None))
-        except StopIteration:
-            pass
+        except Exception: # including StopIteration
+            return
+        finally:
+            self.nactive.transform(lambda n: n - 1)
+        self._schedule(iterable_task)
+
+    def kill_all(self):
+        """attempt to gracefully kill the slaves and the poller"""
+        Slaving.kill_all(self)
+        self._poller.wakeup()
+
+    def _poll_loop(self):
+        """register parked tasks, and queue them once they're ready"""
+        try:
+            while self.alive.get():
+                with self._parked_lock:
+                    parked = self._parked
+                    self._parked = []
+
+                for task, interest in parked:
+                    try:
+                        self._poller.register(*interest)
+                    except (IOError, OSError, ValueError): # let the task fail
+                        self._input_queue.put(TaskInfo(task, None))
+                        continue
+                    self._fds[task] = interest[0]
+                    self._waiting[interest[0]] = task
+
+                    if hasattr(task, "deadline"):
+                        deadline = task.deadline()
+
+                        if not deadline == None:
+                            heapq.heappush(self._deadlines,
+                                (deadline, id(task), task))
+                timeout = None
+
+                if self._deadlines:
+                    timeout = max(0, self._deadlines[0][0] - time.time())
+
+                for fd, events in self._poller.poll(timeout):
+                    if fd in self._waiting:
+                        self._dispatch(fd)
+                now = time.time()
+
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    task = heapq.heappop(self._deadlines)[2]
+
+                    if not task in self._fds: # no longer parked
+                        continue
+                    deadline = task.deadline()
+
+                    if not deadline == None and deadline <= now:
+                        self._dispatch(self._fds[task])
+        finally:
+            self._poller.close()
 
     def put(self, iterable_task):
         """add an iterable task to the queue"""
         if not hasattr(iterable_task, "__iter__"):
             raise TypeError("iterable_task must be iterable")
-        self._input_queue.put(TaskInfo(iterable_task, None))
+        self._schedule(iterable_task)
+
+    def _schedule(self, task):
+        """queue a task, or park it until its interest is ready"""
+        interest = None
+
+        if hasattr(task, "interest"):
+            interest = task.interest()
+
+        if not interest:
+            self._input_queue.put(TaskInfo(task, None))
+            return
+
+        with self._parked_lock:
+            self._parked.append((task, interest))
+        self._poller.wakeup()
+
+    def stats(self):
+        """like Threaded.stats, plus the number of tasks awaiting I/O"""
+        stats = Threaded.stats(self)
+        stats["waiting"] = len(self._waiting)
+        return stats
+
+class Multiplexing(Threaded):
+    """
+    step iterable tasks in a single thread,
+    but only once the I/O they're waiting on is ready
+
+    a task declares what its next step waits on through an interest
+    method, returning (fd, events) or None (ready now);
+    tasks without an interest method are always ready
+
+    a task may also give a deadline method, returning when to step it
+    regardless of its interest (or None)
+    """
+
+    def __init__(self):
+        Threaded.__init__(self, 1)
+        self.alive = Synchronized(True)
+        self._deadlines = [] # heap of (deadline, id(task), task)
+        self._interests = {} # task -> registered (fd, events)
+        self._pending = [] # tasks put since the last pass
+        self._pending_lock = thread.allocate_lock()
+        self._poller = polling.Poller()
+        self._ready = []
+        self._waiting = {} # fd -> task
+        thread.start_new_thread(self._loop, ())
+
+    def _expired(self):
+        """return the waiting tasks whose deadlines have passed"""
+        expired = []
+        now = time.time()
+
+        while self._deadlines and self._deadlines[0][0] <= now:
+            task = heapq.heappop(self._deadlines)[2]
+            interest = self._interests.get(task)
+
+            if not interest or not self._waiting.get(interest[0]) is task:
+                continue # no longer waiting
+            deadline = task.deadline()
+
+            if not deadline == None and deadline <= now:
+                expired.append(self._waiting.pop(interest[0]))
+        return expired
+
+    def _forget(self, task):
+        """stop watching a finished task"""
+        interest = self._interests.pop(task, None)
+
+        if interest:
+            self._waiting.pop(interest[0], None)
+            self._poller.unregister(interest[0])
+
+    def kill_all(self):
+        """gracefully stop the loop"""
+        self.alive.set(False)
+        self._poller.wakeup()
+
+    def _loop(self):
+        """step ready tasks, and wait on the rest"""
+        try:
+            while self.alive.get():
+                with self._pending_lock:
+                    pending = self._pending
+                    self._pending = []
+
+                for task in pending:
+                    self._schedule(task)
+                ready = self._ready
+                self._ready = []
+                timeout = None
+
+                if ready:
+                    timeout = 0
+                elif self._deadlines:
+                    timeout = max(0, self._deadlines[0][0] - time.time())
+
+                for fd, events in self._poller.poll(timeout):
+                    if fd in self._waiting:
+                        ready.append(self._waiting.pop(fd))
+                ready += self._expired()
+
+                for task in ready:
+                    self._step(task)
+        finally:
+            self._poller.close()
+
+    def put(self, iterable_task):
+        """add an iterable task to the loop"""
+        if not hasattr(iterable_task, "__iter__"):
+            raise TypeError("iterable_task must be iterable")
+
+        with self._pending_lock:
+            self._pending.append(iterable_task)
+        self._poller.wakeup()
+
+    def _schedule(self, task):
+        """file a task as ready or waiting, according to its interest"""
+        interest = None
+
+        if hasattr(task, "interest"):
+            interest = task.interest()
+
+        if not interest:
+            self._ready.append(task)
+            return
+        registered = self._interests.get(task)
+
+        if not interest == registered:
+            if registered and not registered[0] == interest[0]:
+                self._waiting.pop(registered[0], None)
+                self._poller.unregister(registered[0])
+            self._poller.register(*interest)
+            self._interests[task] = interest
+        self._waiting[interest[0]] = task
+
+        if hasattr(task, "deadline"):
+            deadline = task.deadline()
+
+            if not deadline == None:
+                heapq.heappush(self._deadlines, (deadline, id(task), task))
+
+    def stats(self):
+        """like Threaded.stats, plus the number of tasks awaiting I/O"""
+        stats = Threaded.stats(self)
+        stats["queued"] = len(self._ready)
+        stats["waiting"] = len(self._waiting)
+        return stats
+
+    def _step(self, task):
+        """execute the next part of a task, then reschedule it"""
+        try:
+            task.next()
+        except Exception: # including StopIteration
+            self._forget(task)
+            return
+        self._schedule(task)
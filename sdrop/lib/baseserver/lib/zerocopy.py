@@ -0,0 +1,126 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+
+__doc__ = """
+zero-copy transfers
+
+each function is None when the platform doesn't provide it,
+so callers should keep a copying fallback
+"""
+
+global sendfile, splice
+
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+PIPE_BUFSIZE = 65536 # default pipe capacity on Linux
+
+SPLICE_F_MOVE = getattr(os, "SPLICE_F_MOVE", 1)
+SPLICE_F_NONBLOCK = getattr(os, "SPLICE_F_NONBLOCK", 2)
+SPLICE_F_MORE = getattr(os, "SPLICE_F_MORE", 4)
+
+# errors meaning "this pair of descriptors can't do that", not "failed"
+UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+_libc = None
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+        use_errno = True)
+except OSError:
+    pass
+
+def _libc_function(names, restype, argtypes):
+    """return the first libc function available under names, or None"""
+    if not _libc:
+        return None
+
+    for name in names:
+        try:
+            function = getattr(_libc, name)
+        except AttributeError:
+            continue
+        function.restype = restype
+        function.argtypes = argtypes
+        return function
+    return None
+
+def _check(result):
+    """raise an OSError for a negative result"""
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+_sendfile = _libc_function(("sendfile64", "sendfile"), ctypes.c_ssize_t,
+    (ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_size_t))
+
+def _libc_sendfile(out_fd, in_fd, offset, count):
+    """send up to count octets from in_fd at offset; return the count sent"""
+    offset = ctypes.c_int64(offset)
+    return _check(_sendfile(out_fd, in_fd, ctypes.byref(offset), count))
+
+sendfile = getattr(os, "sendfile", None) # same signature
+
+if not sendfile and _sendfile:
+    sendfile = _libc_sendfile
+
+def pipe(size = None):
+    """
+    return (read fd, write fd, capacity) for a new pipe,
+    resized toward size octets when possible
+    """
+    r, w = os.pipe()
+    capacity = PIPE_BUFSIZE
+
+    try:
+        if size:
+            fcntl.fcntl(w, F_SETPIPE_SZ, size)
+        capacity = fcntl.fcntl(w, F_GETPIPE_SZ)
+    except IOError: # not Linux, or beyond /proc/sys/fs/pipe-max-size
+        pass
+    return r, w, capacity
+
+_splice = _libc_function(("splice", ), ctypes.c_ssize_t,
+    (ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint))
+
+def _libc_splice(src, dst, count, offset_src = None, offset_dst = None,
+        flags = 0):
+    """
+    move up to count octets from src to dst (one must be a pipe),
+    and return the count moved
+
+    None offsets mean "use (and update) the file position"
+    """
+    offsets = []
+
+    for offset in (offset_src, offset_dst):
+        if not offset == None:
+            offset = ctypes.byref(ctypes.c_int64(offset))
+        offsets.append(offset)
+    return _check(_splice(src, offsets[0], dst, offsets[1], count, flags))
+
+splice = getattr(os, "splice", None) # same signature
+
+if not splice and _splice:
+    splice = _libc_splice
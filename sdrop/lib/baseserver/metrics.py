@@ -0,0 +1,295 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import bisect
+import socket
+import thread
+import time
+
+__doc__ = """
+cheap, in-process metrics, exported in the Prometheus text format
+
+counters and histograms are recorded as they happen (each update
+takes a lock, and little else), while gauges are collected from
+callbacks only when the metrics are rendered
+"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value):
+    """escape a label value"""
+    return str(value).replace('\\', "\\\\").replace('"', "\\\"") \
+        .replace('\n', "\\n")
+
+def _format(value):
+    """format a sample value"""
+    if value == None:
+        return "NaN"
+    elif isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+def _labels(names, values, extra = ()):
+    """format a label set"""
+    pairs = zip(names, values) + list(extra)
+
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (k, _escape(v))
+        for k, v in pairs)
+
+class Metric:
+    """
+    a named family of samples, one for each combination of label values
+
+    labels names the labels, whose values are passed (in the same order)
+    as a tuple whenever the metric is updated
+    """
+
+    TYPE = "untyped"
+
+    def __init__(self, name, help, labels = ()):
+        self.help = help
+        self.labels = tuple(labels)
+        self.name = name
+        self.values = {} # label values -> value
+        self._lock = thread.allocate_lock()
+
+    def render(self):
+        """return the metric's lines"""
+        lines = ["# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.TYPE)]
+
+        with self._lock:
+            values = sorted(self.values.items())
+
+        for key, value in values:
+            lines += self._samples(key, value)
+        return lines
+
+    def _samples(self, key, value):
+        """return the sample lines for a label set"""
+        return ["%s%s %s" % (self.name, _labels(self.labels, key),
+            _format(value))]
+
+class Counter(Metric):
+    """a monotonically increasing count"""
+
+    TYPE = "counter"
+
+    def inc(self, value = 1, key = ()):
+        """add value to the count for the label values in key"""
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+    """
+    a value collected (by calling function) when it's rendered
+
+    function returns either a value, or a dictionary mapping
+    label values to values; the TYPE may be overridden
+    (e.g. for a count kept elsewhere)
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, help, function, labels = (), type = None):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+        if type:
+            self.TYPE = type
+
+    def render(self):
+        values = self.function()
+
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        with self._lock:
+            self.values = values
+        return Metric.render(self)
+
+class Histogram(Metric):
+    """observations, counted in cumulative buckets (upper bounds)"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, key = ()):
+        """record an observation for the label values in key"""
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            entry = self.values.get(key)
+
+            if entry == None: # [per-bucket counts (and +Inf), sum]
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1),
+                    0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def _samples(self, key, value):
+        counts, total = value
+        cumulative = 0
+        lines = []
+
+        for bound, count in zip(self.buckets + (float("inf"), ), counts):
+            cumulative += count
+            lines.append("%s_bucket%s %u" % (self.name,
+                _labels(self.labels, key, (("le", _format(float(bound))), )),
+                cumulative))
+        lines.append("%s_sum%s %s" % (self.name, _labels(self.labels, key),
+            _format(total)))
+        lines.append("%s_count%s %u" % (self.name,
+            _labels(self.labels, key), cumulative))
+        return lines
+
+class Metrics:
+    """
+    a registry of metrics, each named with namespace as a prefix
+
+    metrics are registered once (counter, gauge, histogram),
+    then looked up by their unprefixed names
+    """
+
+    def __init__(self, namespace = ""):
+        self.metrics = {}
+        self.namespace = namespace
+        self._order = []
+
+    def counter(self, name, help, labels = ()):
+        """register and return a Counter"""
+        return self._register(name, Counter(self._name(name), help, labels))
+
+    def gauge(self, name, help, function, labels = (), type = None):
+        """register and return a Gauge"""
+        return self._register(name, Gauge(self._name(name), help, function,
+            labels, type))
+
+    def __getitem__(self, name):
+        return self.metrics[name]
+
+    def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        """register and return a Histogram"""
+        return self._register(name, Histogram(self._name(name), help, labels,
+            buckets))
+
+    def _name(self, name):
+        """return the prefixed name"""
+        if self.namespace:
+            return "%s_%s" % (self.namespace, name)
+        return name
+
+    def _register(self, name, metric):
+        """add a metric"""
+        if name in self.metrics:
+            raise ValueError("duplicate metric: %s" % name)
+        self.metrics[name] = metric
+        self._order.append(metric)
+        return metric
+
+    def render(self):
+        """return every metric in the Prometheus text format"""
+        lines = []
+
+        for metric in self._order:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+class Exporter:
+    """
+    serve the metrics to anything connecting to address
+    (e.g. a Prometheus scraper), from a thread of its own
+
+    every request is answered with the current metrics,
+    and the connection is closed; requests are served one at a time,
+    and a client gets timeout seconds to send its request head
+    """
+
+    def __init__(self, metrics, address, timeout = 1):
+        af = socket.AF_INET
+
+        if len(address) == 4:
+            af = socket.AF_INET6
+        elif not len(address) == 2:
+            raise ValueError("unknown address family")
+        self.alive = True
+        self.metrics = metrics
+        self.timeout = timeout
+        self._sock = socket.socket(af, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(address) # (not shared: see BaseHTTPServer)
+        self._sock.listen(8)
+        self.address = self._sock.getsockname()
+        thread.start_new_thread(self._serve_loop, ())
+
+    def kill(self):
+        """stop serving (waking the blocked accept)"""
+        self.alive = False
+
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _respond(self, conn):
+        """read a request head, then send the metrics"""
+        conn.settimeout(self.timeout)
+        head = ""
+
+        while not "\n\n" in head.replace("\r\n", "\n"):
+            chunk = conn.recv(4096)
+
+            if not chunk or len(head) > 65536:
+                return
+            head += chunk
+        code, body = "200 OK", self.metrics.render()
+
+        if not head.split(' ', 1)[0] in ("GET", "HEAD"):
+            code, body = "405 Method Not Allowed", ""
+        response = "HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %u" \
+            "\r\nConnection: close\r\n\r\n" % (code, CONTENT_TYPE, len(body))
+
+        if not head.startswith("HEAD "):
+            response += body
+        conn.sendall(response)
+
+    def _serve_loop(self):
+        """accept and answer connections until killed"""
+        try:
+            while self.alive:
+                try:
+                    conn, remote = self._sock.accept()
+                except socket.error: # e.g. out of descriptors, or killed
+                    if self.alive:
+                        time.sleep(0.1)
+                    continue
+
+                try:
+                    self._respond(conn)
+                except (EnvironmentError, socket.error):
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            self._sock.close()
@@ -0,0 +1,197 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import errno
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import addr
+import baseserver
+
+__doc__ = "pre-forked, multi-process serving"
+
+class Prefork:
+    """
+    serve from nprocesses forked workers (one per CPU by default),
+    restarting any that exit while the supervisor is alive
+
+    each worker calls server_factory(worker) to build its own server,
+    after the fork: no threads or Python state are shared,
+    and since each server binds its own socket with SO_REUSEPORT,
+    the kernel spreads connections among them; worker numbers
+    run from 0 to nprocesses - 1, and a restarted worker takes
+    the number of the one it replaces (e.g. to pick its own metrics port)
+
+    the supervisor holds the address (bound, but never listening),
+    so a port of 0 is resolved once, and sock_config.ADDRESS updated,
+    before the first fork
+
+    workers that die within MIN_UPTIME seconds are restarted
+    after that long, so a broken server doesn't become a fork loop
+    """
+
+    ERROR_PREFIX = baseserver.BaseServer.ERROR_PREFIX
+    MIN_UPTIME = 1
+    PREFIX = baseserver.BaseServer.PREFIX
+
+    def __init__(self, server_factory, sock_config = baseserver.TCPConfig,
+            nprocesses = None, stderr = sys.stderr, stdout = sys.stdout):
+        if not isinstance(sock_config(), baseserver.TCPConfig):
+            raise TypeError("sock_config must inherit from TCPConfig")
+        elif nprocesses == None:
+            nprocesses = multiprocessing.cpu_count()
+
+        if nprocesses <= 0:
+            raise ValueError("nprocesses must be positive")
+        af = socket.AF_INET
+
+        if len(sock_config.ADDRESS) == 4:
+            af = socket.AF_INET6
+        elif not len(sock_config.ADDRESS) == 2:
+            raise ValueError("unknown address family")
+        self.alive = True
+        self.nprocesses = nprocesses
+        self.server_factory = server_factory
+        self.sock_config = sock_config
+        self.stderr = stderr
+        self.stdout = stdout
+        self.workers = {} # pid -> (worker number, start time)
+        self._sock = socket.socket(af, sock_config.TYPE)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind(sock_config.ADDRESS)
+        self.sock_config.ADDRESS = self._sock.getsockname() # update
+
+    def __call__(self):
+        """start the workers, supervise them, then stop them"""
+        handlers = {}
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            handlers[signum] = signal.signal(signum,
+                lambda signum, frame: self.kill())
+        self.sprint(self.PREFIX, "Supervising %u workers on %s"
+            % (self.nprocesses, addr.atos(self.sock_config.ADDRESS)))
+
+        try:
+            for worker in range(self.nprocesses):
+                if not self.alive:
+                    break
+                self.spawn(worker)
+
+            while self.alive:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                entry = self.workers.pop(pid, None)
+
+                if entry == None or not self.alive:
+                    continue
+                worker, started = entry
+                self.sprinte(self.ERROR_PREFIX, "Worker", pid,
+                    self._describe(status) + ", restarting")
+
+                if time.time() - started < self.MIN_UPTIME:
+                    time.sleep(self.MIN_UPTIME)
+
+                if self.alive:
+                    self.spawn(worker)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            self.cleanup()
+
+    def cleanup(self):
+        """stop the workers, wait for them, and free the address"""
+        self.alive = False
+
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.workers.pop(pid, None)
+
+        while self.workers:
+            try:
+                self.workers.pop(os.wait()[0], None)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                elif not e.errno == errno.EINTR:
+                    raise
+        self._sock.close()
+        self.sprint(self.PREFIX, "Stopped supervising on %s"
+            % addr.atos(self.sock_config.ADDRESS))
+
+    def _describe(self, status):
+        """describe a wait status"""
+        if os.WIFSIGNALED(status):
+            return "was killed by signal %u" % os.WTERMSIG(status)
+        return "exited with status %u" % os.WEXITSTATUS(status)
+
+    def kill(self):
+        """signal a graceful exit (workers finish their current events)"""
+        self.alive = False
+
+    def _serve(self, worker):
+        """run a server in a worker, and return the exit status"""
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self._sock.close()
+
+        try:
+            server = self.server_factory(worker)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.kill())
+            server()
+        except Exception:
+            self.sprinte(self.ERROR_PREFIX, "Worker %u:\n" % os.getpid(),
+                traceback.format_exc())
+            return 1
+        return 0
+
+    def spawn(self, worker):
+        """start a worker, numbered worker"""
+        pid = os.fork()
+
+        if not pid:
+            status = 1
+
+            try:
+                status = self._serve(worker)
+            finally:
+                os._exit(status)
+        self.workers[pid] = (worker, time.time())
+        self.sprint(self.PREFIX, "Started worker", pid)
+
+    def sfprint(self, fp, *args):
+        """print to a file"""
+        for a in args:
+            print >> fp, a,
+        print >> fp
+        fp.flush()
+
+    def sprint(self, *args):
+        """print to STDOUT"""
+        self.sfprint(self.stdout, *args)
+
+    def sprinte(self, *args):
+        """print to STDERR"""
+        self.sfprint(self.stderr, *args)
@@ -0,0 +1,138 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import os
+import random
+import thread
+import time
+
+__doc__ = """
+per-request phase tracing
+
+each request gets a Trace, and each phase it goes through (parsing,
+lock waits, reads, sends, syncs, and so on) is recorded as a span;
+phases that repeat (e.g. one send per chunk) add a span each time
+
+handlers only touch the trace when there is one (see
+HTTPRequestEvent.trace), so tracing that's off costs a check per phase
+"""
+
+class Trace:
+    """the phases of one request, as (phase, start, end) spans"""
+
+    def __init__(self, started = None):
+        if started == None:
+            started = time.time()
+        self.spans = []
+        self.started = started
+
+    def span(self, phase, start, end = None):
+        """record a phase from start until end (by default, now)"""
+        if end == None:
+            end = time.time()
+        self.spans.append((phase, start, end))
+
+    def totals(self):
+        """return the seconds spent in each phase"""
+        totals = {}
+
+        for phase, start, end in self.spans:
+            totals[phase] = totals.get(phase, 0) + end - start
+        return totals
+
+class Tracer:
+    """
+    finish traces: those that took at least slow seconds are logged
+    (log is called with a JSON object, as a line), and a sample of them
+    (the fraction given) is appended to path, in the JSON array flavor
+    of Chrome's trace event format (for chrome://tracing, Perfetto, etc.)
+
+    in the trace file, each request is a thread of its own
+    (named for the request), within the process that served it
+    """
+
+    def __init__(self, slow = 1, sample = 0, path = None, log = None):
+        self.log = log
+        self.path = path
+        self.sample = sample
+        self.slow = slow
+        self._fp = None
+        self._lock = thread.allocate_lock()
+        self._pid = os.getpid()
+        self._serial = 0 # the last trace file thread ID used
+
+    def close(self):
+        """
+        close the trace file (its array is left open, as the format allows,
+        so later runs can append to it)
+        """
+        with self._lock:
+            if self._fp:
+                self._fp.close()
+                self._fp = None
+
+    def finish(self, trace, name, args = None):
+        """
+        finish a request's trace; name describes the request,
+        and args (a dictionary) holds details to record with it
+        """
+        ended = time.time()
+        duration = ended - trace.started
+
+        if args == None:
+            args = {}
+
+        if not self.slow == None and duration >= self.slow and self.log:
+            record = dict(args)
+            record.update({"duration": duration, "phases": trace.totals(),
+                "request": name, "started": trace.started})
+
+            self.log(json.dumps(record, sort_keys = True))
+
+        if self.path and self.sample and random.random() < self.sample:
+            self._write(trace, name, args, ended)
+
+    def trace(self, started = None):
+        """return a new Trace"""
+        return Trace(started)
+
+    def _write(self, trace, name, args, ended):
+        """append a trace to the trace file"""
+        with self._lock:
+            if not self._fp:
+                self._fp = open(self.path, "ab")
+
+                if not self._fp.tell():
+                    self._fp.write("[\n")
+            self._serial += 1
+            tid = self._serial
+            events = [{"args": {"name": name}, "name": "thread_name",
+                    "ph": "M", "pid": self._pid, "tid": tid},
+                self._event(name, trace.started, ended, tid, args)]
+            events += [self._event(phase, start, end, tid)
+                for phase, start, end in trace.spans]
+            self._fp.write("".join(json.dumps(e, sort_keys = True) + ",\n"
+                for e in events))
+            self._fp.flush()
+
+    def _event(self, name, start, end, tid, args = None):
+        """return a complete event"""
+        event = {"dur": int((end - start) * 1e6), "name": name, "ph": "X",
+            "pid": self._pid, "tid": tid, "ts": int(start * 1e6)}
+
+        if args:
+            event["args"] = args
+        return event
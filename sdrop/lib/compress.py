@@ -0,0 +1,191 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import struct
+import zlib
+
+__doc__ = """
+transparent compression for drops at rest
+
+a drop is stored either as is, or after a HEADER_SIZE-octet header:
+MAGIC, a flag (DEFLATED for a zlib stream, or STORED when the data
+follows as is), and the original size (a big-endian, unsigned 64-bit
+integer); the header is only used for data that compressed,
+or that itself begins with MAGIC (or another prefix the caller
+escapes, e.g. cryptoerase.MAGIC), so it can't be misread
+"""
+
+DEFLATED = '\x01'
+HEADER_SIZE = 17
+MAGIC = "\x89SDROP\r\n"
+STORED = '\x00'
+
+class Compressor:
+    """
+    write data to a file, compressed with zlib at level,
+    unless it doesn't compress (a level of 0 never does)
+
+    the first probe octets are held back until they show whether
+    the data compresses to at most ratio of its size;
+    if not, all of it is written as is (after a STORED header,
+    if it begins with one of escapes)
+
+    stored is the number of octets written to the file
+    """
+
+    def __init__(self, fp, level = 6, probe = 65536, ratio = 0.9,
+            escapes = (MAGIC, )):
+        self.compressor = None
+        self.escapes = tuple(escapes)
+        self.fp = fp
+        self.level = level
+        self.probe = probe
+        self.ratio = ratio
+        self.size = 0 # original octets
+        self.stored = 0
+        self._decided = False
+        self._header = False
+        self._pending = []
+
+    def close(self):
+        """flush everything to the file (though the file isn't closed)"""
+        if not self._decided:
+            self._decide()
+
+        if self.compressor:
+            self._write(self.compressor.flush())
+            self.compressor = None
+
+        if self._header: # now the size is known
+            self.fp.seek(len(MAGIC) + 1, os.SEEK_SET)
+            self.fp.write(struct.pack(">Q", self.size))
+            self.fp.seek(0, os.SEEK_END)
+
+    def _decide(self):
+        """write the held-back data, either compressed or as is"""
+        probe = "".join(self._pending)
+        self._decided = True
+        self._pending = []
+
+        if self.level and probe:
+            compressor = zlib.compressobj(self.level)
+            compressed = compressor.compress(probe) \
+                + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+            if len(compressed) <= len(probe) * self.ratio:
+                self.compressor = compressor
+                self._write_header(DEFLATED)
+                self._write(compressed)
+                return
+
+        if probe.startswith(self.escapes): # or it'd be misread
+            self._write_header(STORED)
+        self._write(probe)
+
+    def passthrough(self):
+        """
+        return whether data is now written as is, without a header
+        (so it may also be appended to the file directly)
+        """
+        return self._decided and not self.compressor and not self._header
+
+    def write(self, data):
+        """write (or hold back) data"""
+        self.size += len(data)
+
+        if self.compressor:
+            self._write(self.compressor.compress(data))
+        elif self._decided:
+            self._write(data)
+        else:
+            self._pending.append(data)
+
+            if self.size >= self.probe:
+                self._decide()
+
+    def _write(self, data):
+        """write to the file"""
+        self.fp.write(data)
+        self.stored += len(data)
+
+    def _write_header(self, flag):
+        """write a header (the size is filled in by close)"""
+        self._header = True
+        self._write(MAGIC + flag + struct.pack(">Q", 0))
+
+class Decompressor:
+    """
+    read the original data of a stored drop from fp,
+    starting at offset (just past its header)
+    """
+
+    def __init__(self, fp, offset = HEADER_SIZE, bufsize = 65536):
+        self.bufsize = bufsize
+        self.decompressor = zlib.decompressobj()
+        self.fp = fp
+        self.offset = offset
+        self._tail = "" # compressed, but not yet decompressed
+
+    def read(self, n):
+        """
+        return up to n octets ("" at the end)
+
+        raises zlib.error for a corrupt stream
+        """
+        while 1:
+            if not self._tail:
+                self.fp.seek(self.offset, os.SEEK_SET)
+                self._tail = self.fp.read(self.bufsize)
+                self.offset += len(self._tail)
+
+                if not self._tail:
+                    return self.decompressor.flush()
+            data = self.decompressor.decompress(self._tail, n)
+            self._tail = self.decompressor.unconsumed_tail
+
+            if data:
+                return data
+
+def header(fp):
+    """
+    return a stored drop's (flag, original size) from its header,
+    or None if it's stored as is without one
+    """
+    fp.seek(0, os.SEEK_SET)
+    return parse_header(fp.read(HEADER_SIZE))
+
+def parse_header(data):
+    """like header, but given a stored drop's first HEADER_SIZE octets"""
+    if not len(data) == HEADER_SIZE or not data.startswith(MAGIC) \
+            or not data[len(MAGIC)] in (DEFLATED, STORED):
+        return None
+    return data[len(MAGIC)], struct.unpack(">Q", data[len(MAGIC) + 1:])[0]
+
+def original_size(path, st):
+    """return a stored drop's original size, given its stat"""
+    if st.st_size < HEADER_SIZE:
+        return st.st_size
+
+    try:
+        with open(path, "rb") as fp:
+            info = header(fp)
+    except IOError:
+        return st.st_size
+    return st.st_size if info == None else info[1]
+
+def stored_header(size):
+    """return a STORED header for size octets"""
+    return MAGIC + STORED + struct.pack(">Q", size)
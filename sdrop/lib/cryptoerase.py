@@ -0,0 +1,161 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import ctypes
+import os
+import thread
+
+import compress
+import keystream
+
+__doc__ = """
+encryption at rest, so that erasing a drop is destroying its key
+
+each drop is encrypted under its own random key (with a keystream,
+see keystream), which is only ever held in memory: once it's gone,
+so is the drop, whatever's left on disk
+
+an encrypted drop begins with MAGIC, followed by the ciphertext
+"""
+
+MAGIC = "\x89SDENC\r\n"
+
+class EncryptedFile:
+    """
+    a file-like view of an encrypted drop's plaintext
+
+    offsets are within the plaintext (past MAGIC), and data is
+    encrypted as it's written, and decrypted as it's read;
+    a new drop's header is written when create is set,
+    and otherwise checked (raising an IOError if it's missing)
+    """
+
+    def __init__(self, fp, stream, create = False):
+        self.fp = fp
+        self.stream = stream
+
+        if create:
+            self.fp.write(MAGIC)
+        else:
+            self.fp.seek(0, os.SEEK_SET)
+
+            if not self.fp.read(len(MAGIC)) == MAGIC:
+                raise IOError("not an encrypted drop")
+        self.stream.seek(0)
+
+    def close(self):
+        self.fp.close()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def flush(self):
+        self.fp.flush()
+
+    def read(self, n = -1):
+        return self.stream.xor(self.fp.read(n))
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            offset += len(MAGIC)
+        self.fp.seek(offset, whence)
+        self.stream.seek(self.tell())
+
+    def tell(self):
+        return self.fp.tell() - len(MAGIC)
+
+    def write(self, data):
+        self.fp.write(self.stream.xor(data))
+
+class Key:
+    """
+    a random key, zeroed in place once it's wiped
+
+    (this is best effort: keystreams, and the interpreter, may hold
+    transient copies until they're collected)
+    """
+
+    def __init__(self):
+        self._buffer = ctypes.create_string_buffer(os.urandom(
+            keystream.KEY_SIZE), keystream.KEY_SIZE)
+
+    def keystream(self):
+        """return a keystream under the key"""
+        if self._buffer == None:
+            raise ValueError("the key was wiped")
+        return keystream.Keystream(self._buffer.raw)
+
+    def wipe(self):
+        """destroy the key"""
+        if not self._buffer == None:
+            ctypes.memset(self._buffer, 0, len(self._buffer))
+            self._buffer = None
+
+class KeyStore:
+    """the keys of the encrypted drops, by path"""
+
+    def __init__(self):
+        self.keys = {}
+        self._lock = thread.allocate_lock()
+
+    def create(self, path):
+        """make, store and return a new key for the drop at path"""
+        key = Key()
+
+        with self._lock:
+            self.keys[path] = key
+        return key
+
+    def destroy(self, path, key):
+        """
+        wipe a key (e.g. a failed upload's), removing it from the store
+        if it's still there
+        """
+        with self._lock:
+            if self.keys.get(path) is key:
+                del self.keys[path]
+        key.wipe()
+
+    def get(self, path):
+        """return the key for path, or None"""
+        return self.keys.get(path)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def pop(self, path):
+        """remove and return the key for path, or None"""
+        with self._lock:
+            return self.keys.pop(path, None)
+
+def original_size(path, st):
+    """
+    like compress.original_size, though an encrypted drop's is None:
+    without its key (which died with the process that stored it),
+    it's unreadable
+    """
+    if st.st_size < len(MAGIC):
+        return st.st_size
+
+    try:
+        with open(path, "rb") as fp:
+            data = fp.read(max(len(MAGIC), compress.HEADER_SIZE))
+    except IOError:
+        return st.st_size
+
+    if data.startswith(MAGIC):
+        return None
+    info = compress.parse_header(data[:compress.HEADER_SIZE])
+    return st.st_size if info == None else info[1]
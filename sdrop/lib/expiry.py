@@ -0,0 +1,81 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import heapq
+import thread
+import threading
+import time
+
+__doc__ = "deadlines for drops"
+
+class Expiry:
+    """
+    call expire(path, token) once each scheduled deadline passes,
+    from a single thread that sleeps until the earliest one
+
+    deadlines are kept in a heap, so scheduling costs O(log n),
+    as does each expiry; nothing is ever cancelled (a drop fetched
+    early stays in the heap until its deadline), so expire should use
+    the token to check that the drop at path is still the one scheduled
+    """
+
+    def __init__(self, expire):
+        self.alive = True
+        self.expire = expire
+        self._cond = threading.Condition()
+        self._heap = [] # (deadline, sequence, path, token)
+        self._sequence = 0 # breaks ties, so tokens are never compared
+        self._started = False
+
+    def kill(self):
+        """stop the thread (deadlines still pending are dropped)"""
+        with self._cond:
+            self.alive = False
+            self._cond.notify()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _loop(self):
+        """wait for deadlines, and expire what's due"""
+        while True:
+            with self._cond:
+                while self.alive and (not self._heap
+                        or self._heap[0][0] > time.time()):
+                    timeout = None
+
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.time()
+                    self._cond.wait(timeout)
+
+                if not self.alive:
+                    break
+                deadline, sequence, path, token = heapq.heappop(self._heap)
+            self.expire(path, token)
+
+    def schedule(self, deadline, path, token = None):
+        """expire path at deadline (seconds since the epoch)"""
+        with self._cond:
+            if not self.alive:
+                return
+            heapq.heappush(self._heap, (deadline, self._sequence, path,
+                token))
+            self._sequence += 1
+
+            if not self._started: # there's something to wait for
+                thread.start_new_thread(self._loop, ())
+                self._started = True
+            elif self._heap[0][1] == self._sequence - 1: # the new earliest
+                self._cond.notify()
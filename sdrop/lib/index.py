@@ -0,0 +1,138 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import stat
+import thread
+import time
+
+__doc__ = "an in-memory index of the drops under a root"
+
+class DropIndex:
+    """
+    map each drop's path to an entry:
+    [size, state, creation time, stored size (on disk)]
+
+    a drop is UPLOADING until it's stored, then READY until a fetch
+    claims it (FETCHING), after which it's removed; a resumable upload
+    is INCOMPLETE between its pieces
+
+    the index is rebuilt by scanning the root (skipping the excluded
+    directories) on startup; since it's then the only record consulted,
+    the root mustn't be modified behind its back (e.g. by another process)
+
+    a scanned drop's size is size(path, lstat result)
+    (by default, the stored size); when that's None, the drop isn't
+    indexed, but listed in discarded instead
+    """
+
+    FETCHING = "fetching"
+    INCOMPLETE = "incomplete"
+    READY = "ready"
+    UPLOADING = "uploading"
+
+    def __init__(self, root, exclude = (), size = None):
+        self.discarded = []
+        self.entries = {}
+        self.exclude = [os.path.normpath(d) for d in exclude]
+        self.root = root
+        self.size = size
+        self._lock = thread.allocate_lock()
+        self._scan()
+
+    def add(self, path, size):
+        """
+        add an uploading drop, and return whether path was free
+        (if not, the index is unchanged)
+        """
+        with self._lock:
+            if path in self.entries:
+                return False
+            self.entries[path] = [size, DropIndex.UPLOADING, time.time(),
+                0]
+            return True
+
+    def claim(self, path):
+        """mark a ready drop as being fetched, and return whether it was"""
+        with self._lock:
+            entry = self.entries.get(path)
+
+            if not entry or not entry[1] == DropIndex.READY:
+                return False
+            entry[1] = DropIndex.FETCHING
+            return True
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def get(self, path):
+        """return the entry for path, or None"""
+        return self.entries.get(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def mark(self, path, state):
+        """change a drop's state"""
+        with self._lock:
+            entry = self.entries.get(path)
+
+            if entry:
+                entry[1] = state
+
+    def ready(self, path, size, stored = None):
+        """
+        mark an uploaded drop as ready, with its final size
+        (and stored size, if it differs)
+        """
+        if stored == None:
+            stored = size
+
+        with self._lock:
+            entry = self.entries.get(path)
+
+            if entry:
+                entry[:2] = [size, DropIndex.READY]
+                entry[3] = stored
+
+    def remove(self, path):
+        """forget a drop"""
+        with self._lock:
+            self.entries.pop(path, None)
+
+    def _scan(self):
+        """index the regular files under the root"""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in list(dirnames):
+                if os.path.normpath(os.path.join(dirpath, name)) \
+                        in self.exclude:
+                    dirnames.remove(name)
+
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+
+                if stat.S_ISREG(st.st_mode):
+                    size = self.size(path, st) if self.size else st.st_size
+
+                    if size == None:
+                        self.discarded.append(path)
+                        continue
+                    self.entries[path] = [size, DropIndex.READY, st.st_mtime,
+                        st.st_size]
@@ -0,0 +1,145 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import binascii
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import struct
+
+__doc__ = """
+seekable keystreams from a CSPRNG seeded once (by a key)
+
+AES-256-CTR from libcrypto (OpenSSL) when it can be loaded,
+otherwise SHA-512 in counter mode (hashlib, and much slower);
+MECHANISM names the one in use
+"""
+
+global MECHANISM
+
+KEY_SIZE = 32
+NONCE_SIZE = 16
+
+_libcrypto = None
+
+try:
+    _libcrypto = ctypes.CDLL(ctypes.util.find_library("crypto")
+        or "libcrypto.so")
+
+    for name, restype, argtypes in (
+            ("EVP_CIPHER_CTX_free", None, (ctypes.c_void_p, )),
+            ("EVP_CIPHER_CTX_new", ctypes.c_void_p, ()),
+            ("EVP_EncryptInit_ex", ctypes.c_int, (ctypes.c_void_p,
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p,
+                ctypes.c_char_p)),
+            ("EVP_EncryptUpdate", ctypes.c_int, (ctypes.c_void_p,
+                ctypes.c_char_p, ctypes.POINTER(ctypes.c_int),
+                ctypes.c_char_p, ctypes.c_int)),
+            ("EVP_aes_256_ctr", ctypes.c_void_p, ())):
+        function = getattr(_libcrypto, name)
+        function.argtypes = argtypes
+        function.restype = restype
+except (AttributeError, OSError):
+    _libcrypto = None
+MECHANISM = "aes-256-ctr" if _libcrypto else "sha512-ctr"
+
+def xor(a, b):
+    """return the XOR of two equal-length strings"""
+    if not a:
+        return ""
+    return binascii.unhexlify("%0*x" % (2 * len(a),
+        int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)))
+
+class Keystream:
+    """
+    a keystream determined by a key (random unless given) and a nonce
+
+    read returns the next octets of the keystream, and xor applies them
+    to data (encrypting or decrypting it); seek moves to any offset
+    """
+
+    def __init__(self, key = None, nonce = '\0' * NONCE_SIZE):
+        if key == None:
+            key = os.urandom(KEY_SIZE)
+        elif not len(key) == KEY_SIZE or not len(nonce) == NONCE_SIZE:
+            raise ValueError("key/nonce must be %u/%u octets" % (KEY_SIZE,
+                NONCE_SIZE))
+        self._ctx = None
+        self.key = key
+        self.nonce = nonce
+        self.offset = 0
+        self.seek(0)
+
+    def __del__(self):
+        if self._ctx and _libcrypto:
+            _libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+    def _blocks(self, data):
+        """apply the SHA-512 keystream to data (the fallback)"""
+        stream = []
+        block, skip = divmod(self.offset, 64)
+        needed = len(data) + skip
+
+        while needed > 0:
+            stream.append(hashlib.sha512(self.key + self.nonce
+                + struct.pack(">Q", block)).digest())
+            block += 1
+            needed -= 64
+        return xor(data, "".join(stream)[skip:skip + len(data)])
+
+    def read(self, n):
+        """return the next n octets of the keystream"""
+        return self.xor('\0' * n)
+
+    def seek(self, offset):
+        """move to an offset within the keystream"""
+        self.offset = offset
+
+        if not _libcrypto:
+            return
+        elif not self._ctx:
+            self._ctx = _libcrypto.EVP_CIPHER_CTX_new()
+        block, skip = divmod(offset, 16)
+        counter = (int(binascii.hexlify(self.nonce), 16) + block) \
+            % (1 << 8 * NONCE_SIZE)
+        iv = binascii.unhexlify("%032x" % counter)
+
+        if not _libcrypto.EVP_EncryptInit_ex(self._ctx,
+                _libcrypto.EVP_aes_256_ctr(), None, self.key, iv):
+            raise RuntimeError("EVP_EncryptInit_ex failed")
+
+        if skip:
+            self._update('\0' * skip)
+
+    def _update(self, data):
+        """apply the AES keystream to data"""
+        out = ctypes.create_string_buffer(len(data))
+        outlen = ctypes.c_int(0)
+
+        if not _libcrypto.EVP_EncryptUpdate(self._ctx, out,
+                ctypes.byref(outlen), data, len(data)):
+            raise RuntimeError("EVP_EncryptUpdate failed")
+        return out.raw[:outlen.value]
+
+    def xor(self, data):
+        """apply the next len(data) octets of the keystream to data"""
+        if _libcrypto:
+            data = self._update(data)
+        else:
+            data = self._blocks(data)
+        self.offset += len(data)
+        return data
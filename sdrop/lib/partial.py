@@ -0,0 +1,116 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import re
+import thread
+import time
+
+import baseserver
+
+__doc__ = "resumable (partial) uploads"
+
+_CONTENT_RANGE = re.compile(r"^bytes\s+(\d+)-(\d+)/(\d+)$")
+
+def parse_content_range(value):
+    """
+    parse a Content-Range header ("bytes FIRST-LAST/LENGTH"),
+    and return (first, last, length)
+
+    raises an HTTPError (400) when it's malformed or unsatisfiable
+    """
+    match = _CONTENT_RANGE.match(str(value).strip())
+
+    if not match:
+        raise baseserver.HTTPError(400, "Bad Request")
+    first, last, length = [int(g) for g in match.groups()]
+
+    if not first <= last < length:
+        raise baseserver.HTTPError(400, "Bad Request")
+    return first, last, length
+
+class PartialUpload:
+    """
+    an incomplete upload of length octets to path,
+    of which received have been stored in temp
+
+    it's busy while a piece is being appended,
+    and abandoned once idle past its deadline
+    """
+
+    def __init__(self, path, temp, length):
+        self.busy = True
+        self.deadline = None
+        self.length = length
+        self.path = path
+        self.received = 0
+        self.temp = temp
+
+class PartialUploads:
+    """the incomplete uploads, by path"""
+
+    def __init__(self):
+        self.uploads = {}
+        self._lock = thread.allocate_lock()
+
+    def acquire(self, path):
+        """
+        mark the upload to path as busy, and return it,
+        or None if there isn't one
+
+        raises an HTTPError (409) when it's already busy
+        """
+        with self._lock:
+            upload = self.uploads.get(path)
+
+            if not upload:
+                return None
+            elif upload.busy:
+                raise baseserver.HTTPError(409, "Conflict")
+            upload.busy = True
+            return upload
+
+    def add(self, path, temp, length):
+        """add a new (busy) upload, and return it"""
+        with self._lock:
+            upload = PartialUpload(path, temp, length)
+            self.uploads[path] = upload
+            return upload
+
+    def get(self, path):
+        """return the upload to path, or None"""
+        return self.uploads.get(path)
+
+    def __len__(self):
+        return len(self.uploads)
+
+    def release(self, upload, deadline):
+        """mark an upload as idle until deadline"""
+        with self._lock:
+            upload.busy = False
+            upload.deadline = deadline
+
+    def remove(self, upload, idle = False):
+        """
+        forget an upload, and return whether it was still there
+        (when idle is set, only if it's idle and past its deadline)
+        """
+        with self._lock:
+            if not self.uploads.get(upload.path) is upload:
+                return False
+            elif idle and (upload.busy or upload.deadline == None
+                    or upload.deadline > time.time()):
+                return False
+            del self.uploads[upload.path]
+            return True
@@ -0,0 +1,188 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import ctypes
+import ctypes.util
+import mmap
+import thread
+
+__doc__ = """
+an in-memory storage tier for small drops
+
+each drop lives in its own anonymous mapping, locked into RAM
+(so it's never swapped out) and excluded from core dumps when possible;
+it's zeroed in place once fetched or discarded
+"""
+
+MADV_DONTDUMP = 16
+
+_libc = None
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+        use_errno = True)
+
+    for name in ("madvise", "mlock", "munlock"):
+        function = getattr(_libc, name)
+        function.argtypes = (ctypes.c_void_p, ctypes.c_size_t) \
+            + ((ctypes.c_int, ) if name == "madvise" else ())
+        function.restype = ctypes.c_int
+except (AttributeError, OSError):
+    _libc = None
+
+class RAMDrop:
+    """
+    a drop held in locked memory
+
+    it's ready once the whole body has been written
+    """
+
+    def __init__(self, size):
+        self.ready = False
+        self.size = size
+        self.written = 0
+        self._map = mmap.mmap(-1, max(1, size)) # mmap refuses 0
+        self._address = ctypes.addressof(ctypes.c_char.from_buffer(
+            self._map))
+        self._length = len(self._map)
+
+        if not _libc or _libc.mlock(self._address, self._length):
+            self._map.close()
+            e = ctypes.get_errno() if _libc else 0
+            raise MemoryError("can't lock %u octets (errno %u)"
+                % (self._length, e))
+        _libc.madvise(self._address, self._length, MADV_DONTDUMP)
+
+    def read(self, offset, n):
+        """return up to n octets from offset"""
+        return self._map[offset:min(offset + n, self.written)]
+
+    def wipe(self):
+        """
+        zero, unlock and release the memory,
+        and return whether it hadn't been already
+        """
+        if self._map == None:
+            return False
+        ctypes.memset(self._address, 0, self._length)
+        _libc.munlock(self._address, self._length)
+        self._map.close()
+        self._map = None
+        self.written = 0
+        return True
+
+    def write(self, data):
+        """append data, and return the amount written"""
+        data = data[:self.size - self.written]
+        self._map[self.written:self.written + len(data)] = data
+        self.written += len(data)
+        return len(data)
+
+class RAMTier:
+    """
+    hold drops of up to max_drop octets in locked memory,
+    within budget octets (counted in whole pages)
+
+    drops that would fit by size, but not within the budget
+    (or that can't be locked), spill to disk; both hits (drops fetched
+    from memory) and spills are counted
+    """
+
+    def __init__(self, budget, max_drop):
+        self.budget = budget
+        self.drops = {} # path -> RAMDrop
+        self.hits = 0
+        self.max_drop = max_drop
+        self.spills = 0
+        self.used = 0
+        self._lock = thread.allocate_lock()
+
+    def claim(self, path, drop):
+        """
+        take a ready drop for fetching, and return whether it was
+        still there (a concurrent fetch may have claimed it)
+        """
+        with self._lock:
+            if not self.drops.get(path) is drop:
+                return False
+            del self.drops[path]
+            self.hits += 1
+            return True
+
+    def __contains__(self, path):
+        return path in self.drops
+
+    def discard(self, path, drop):
+        """
+        remove and wipe a drop (e.g. a failed upload or an expired one),
+        and return whether it was still there (if not, it's left alone:
+        a fetch may have claimed it)
+        """
+        with self._lock:
+            if not self.drops.get(path) is drop:
+                return False
+            del self.drops[path]
+        self.release(drop)
+        return True
+
+    def get(self, path):
+        """return the drop at path, or None"""
+        return self.drops.get(path)
+
+    def _pages(self, size):
+        """return size, rounded up to whole pages"""
+        return max(1, -(-size // mmap.PAGESIZE)) * mmap.PAGESIZE
+
+    def release(self, drop):
+        """wipe a drop taken with claim, and give back its memory"""
+        if not drop.wipe():
+            return
+
+        with self._lock:
+            self.used -= self._pages(drop.size)
+
+    def reserve(self, path, size):
+        """
+        return a new RAMDrop for an upload of size octets to path,
+        or None if it belongs on disk
+        """
+        if not self.budget or size > self.max_drop:
+            return None
+        pages = self._pages(size)
+
+        with self._lock:
+            if path in self.drops: # a concurrent upload (it'll conflict)
+                return None
+            elif self.used + pages > self.budget:
+                self.spills += 1
+                return None
+            self.used += pages
+
+        try:
+            drop = RAMDrop(size)
+        except (EnvironmentError, MemoryError, ValueError):
+            with self._lock:
+                self.spills += 1
+                self.used -= pages
+            return None
+
+        with self._lock:
+            self.drops[path] = drop
+        return drop
+
+    def stats(self):
+        """return a dictionary of counters"""
+        return {"drops": len(self.drops), "hits": self.hits,
+            "spills": self.spills, "used": self.used}
@@ -0,0 +1,297 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import binascii
+import errno
+import os
+import Queue
+import thread
+import time
+
+from baseserver.lib import threaded
+import keystream
+
+__doc__ = "background file shredding"
+
+class Pattern:
+    """
+    what a file is overwritten with:
+    each of PASSES passes overwrites the whole file
+
+    a new instance is made for each file
+    """
+
+    PASSES = 1
+
+    def __init__(self):
+        pass
+
+    def fill(self, n, _pass = 0):
+        """return n octets to write during a pass"""
+        raise NotImplementedError()
+
+class KeystreamPattern(Pattern):
+    """a keystream from a CSPRNG seeded once per file"""
+
+    def __init__(self):
+        Pattern.__init__(self)
+        self.keystream = keystream.Keystream()
+
+    def fill(self, n, _pass = 0):
+        return self.keystream.read(n)
+
+class URandomPattern(Pattern):
+    """os.urandom for every chunk"""
+
+    def fill(self, n, _pass = 0):
+        return os.urandom(n)
+
+class ZeroPattern(Pattern):
+    """zeros"""
+
+    def fill(self, n, _pass = 0):
+        return '\0' * n
+
+class MultipassPattern(KeystreamPattern):
+    """zeros, then ones, then a keystream"""
+
+    PASSES = 3
+
+    def fill(self, n, _pass = 0):
+        if _pass == 0:
+            return '\0' * n
+        elif _pass == 1:
+            return '\xff' * n
+        return KeystreamPattern.fill(self, n)
+
+PATTERNS = {"keystream": KeystreamPattern, "multipass": MultipassPattern,
+    "urandom": URandomPattern, "zero": ZeroPattern}
+
+class ShredJob(threaded.IterableTask):
+    """
+    overwrite a file chunk by chunk (syncing as it goes), then unlink it
+
+    each step returns the number of octets overwritten (and passes them
+    to overwritten, if given, and how long its sync took, in seconds,
+    to synced, if given); once the file is unlinked,
+    unlinked (if given) is called with its path
+    """
+
+    def __init__(self, path, bufsize = 1048576, pattern = URandomPattern,
+            unlinked = None, overwritten = None, synced = None):
+        threaded.IterableTask.__init__(self)
+        self.bufsize = bufsize
+        self.fp = None
+        self.offset = 0
+        self.overwritten = overwritten
+        self._pass = 0
+        self.path = path
+        self.pattern = pattern()
+        self.size = 0
+        self.synced = synced
+        self.unlinked = unlinked
+
+    def next(self):
+        if not self.path:
+            raise StopIteration()
+
+        try:
+            if not self.fp:
+                self.fp = open(self.path, "r+b")
+                self.fp.seek(0, os.SEEK_END)
+                self.size = self.fp.tell()
+                self.fp.seek(0, os.SEEK_SET)
+
+            if self.offset >= self.size \
+                    and self._pass + 1 < self.pattern.PASSES: # next pass
+                self._pass += 1
+                self.offset = 0
+                self.fp.seek(0, os.SEEK_SET)
+
+            if self.offset < self.size:
+                chunk = min(self.bufsize, self.size - self.offset)
+                self.fp.write(self.pattern.fill(chunk, self._pass))
+                self.fp.flush()
+                started = time.time()
+                os.fdatasync(self.fp.fileno())
+
+                if self.synced:
+                    self.synced(time.time() - started)
+                self.offset += chunk
+
+                if self.overwritten:
+                    self.overwritten(chunk)
+                return chunk
+        except (IOError, OSError): # unlink it regardless
+            pass
+        self.unlink()
+        raise StopIteration()
+
+    def unlink(self):
+        """close and unlink the file"""
+        if self.fp:
+            try:
+                self.fp.close()
+            except (IOError, OSError):
+                pass
+            self.fp = None
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+        if self.unlinked:
+            self.unlinked(self.path)
+        self.path = None
+
+class Shredder:
+    """
+    shred files in the background
+
+    a file is claimed by renaming it into the queue directory
+    (which must be on the same filesystem), so it can't be reached
+    under its old name; once handed over (put), one of nthreads workers
+    shreds it
+
+    at most depth files wait in the queue, and when rate is given,
+    the workers overwrite at most rate octets per second between them;
+    files left in the queue directory (e.g. by a crash)
+    are shredded on startup: those there when the Shredder is made,
+    so nothing claimed since is queued twice (the directory
+    mustn't be used for anything else)
+
+    pattern names the overwrite pattern (see PATTERNS),
+    and unlinked and synced are passed along to each ShredJob;
+    overwritten counts the octets they overwrite
+    """
+
+    def __init__(self, directory, nthreads = 1, depth = 1024, rate = None,
+            bufsize = 1048576, pattern = "urandom", unlinked = None,
+            synced = None):
+        if nthreads <= 0:
+            raise ValueError("nthreads must be positive")
+        elif not pattern in PATTERNS:
+            raise ValueError("unknown shred pattern: %s" % repr(pattern))
+        self.alive = threaded.Synchronized(True)
+        self.bufsize = bufsize
+        self.directory = os.path.normpath(directory)
+        self.nthreads = nthreads
+        self.overwritten = 0
+        self.pattern = PATTERNS[pattern]
+        self.rate = rate
+        self._count_lock = thread.allocate_lock()
+        self._next_slot = 0 # when the rate limit admits the next chunk
+        self._queue = Queue.Queue(depth)
+        self._rate_lock = thread.allocate_lock()
+        self.synced = synced
+        self.unlinked = unlinked
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory, 0700)
+            except OSError as e: # (another process may have made it)
+                if not e.errno == errno.EEXIST:
+                    raise
+
+        try: # before anything's claimed
+            leftovers = os.listdir(self.directory)
+        except OSError:
+            leftovers = []
+
+        for i in range(self.nthreads):
+            thread.start_new_thread(self._shred_loop, ())
+        thread.start_new_thread(self._recover, (leftovers, ))
+
+    def claim(self, path):
+        """move a file into the queue directory, and return its new path"""
+        claimed = os.path.join(self.directory, "%x-%s" % (
+            int(time.time() * 1e6), binascii.hexlify(os.urandom(8))))
+        os.rename(path, claimed)
+        return claimed
+
+    def _count(self, octets):
+        """count octets overwritten"""
+        with self._count_lock:
+            self.overwritten += octets
+
+    def kill_all(self):
+        """stop the workers once they finish their current files"""
+        self.alive.set(False)
+
+        for i in range(self.nthreads):
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full: # they'll notice alive
+                break
+
+    def owns(self, path):
+        """return whether path is the queue directory or within it"""
+        path = os.path.normpath(path)
+        return path == self.directory \
+            or path.startswith(self.directory + os.sep)
+
+    def put(self, path):
+        """
+        queue a claimed file for shredding
+
+        if the queue is full, return the ShredJob instead:
+        the caller should run it (a step at a time, if need be)
+        """
+        job = ShredJob(path, self.bufsize, self.pattern, self.unlinked,
+            self._count, self.synced)
+
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            return job
+        return None
+
+    def qsize(self):
+        """return the approximate number of files waiting"""
+        return self._queue.qsize()
+
+    def _recover(self, names):
+        """queue the files (by name) left in the queue directory"""
+        for name in names:
+            if not self.alive.get():
+                break
+            self._queue.put(ShredJob(os.path.join(self.directory, name),
+                self.bufsize, self.pattern, self.unlinked, self._count,
+                self.synced))
+
+    def _shred_loop(self):
+        """shred queued files as they appear"""
+        while self.alive.get():
+            job = self._queue.get()
+
+            if job == None:
+                break
+
+            for octets in job:
+                self._throttle(octets)
+
+    def _throttle(self, octets):
+        """sleep as long as the rate limit requires"""
+        if not self.rate:
+            return
+
+        with self._rate_lock:
+            now = time.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + float(octets) / self.rate
+
+        if slot > now:
+            time.sleep(slot - now)
@@ -13,171 +13,1466 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import errno
 import fcntl
 import os
 import socket
 import sys
+import tempfile
+import time
+import zlib
 
+from lib import accounting
 from lib import baseserver
+from lib import compress
 from lib import conf
+from lib import cryptoerase
+from lib import expiry
+from lib import index
+from lib import partial
+from lib import ramtier
+from lib import shred
 
 __doc__ = "sdrop - a temporary file drop server"
 
-class GETHandler(baseserver.HTTPRequestHandler):
-    """identical to its parent, though it shreds and unlinks the resource"""
+class GETHandler(baseserver.GETHandler):
+    """
+    identical to its parent, though the resource can only be fetched once:
+    it's claimed by the server's shredder before it's sent,
+    then shredded (and unlinked) in the background
+
+    drops in the server's RAM tier are claimed from it instead,
+    then zeroed in place
+
+    with a drop index, paths it doesn't hold are never looked up on disk
+    (see also SDropServer.claim)
+
+    a drop stored compressed (see compress) is decompressed as it's sent,
+    and an encrypted one (see cryptoerase) is decrypted; its key is taken
+    from the server before it's sent, and it's erased afterward
+    (see SDropServer.dispose)
+
+    when traced, the claim, reads and sends, and disposal
+    (including any shredding done here) are recorded as phases
+    """
     
     def __init__(self, *args, **kwargs):
-        baseserver.HTTPRequestHandler.__init__(self, *args,
-            **kwargs)
-        self.content_length = -1
-        self.fp = None
-        self.locked = False
-        self.path = self.event.server.resolve(self.event.request.resource)
-        
-        if os.path.exists(self.path) and not os.path.isdir(self.path):
-            try:
-                self.fp = open(self.path, "r+b")
-                self.fp.seek(0, os.SEEK_END)
-                self.content_length = self.fp.tell()
-                self.headers["content-length"] = self.content_length
-                self.fp.seek(0, os.SEEK_SET)
-            except (IOError, OSError):
-                self.code = 500
-                self.message = "Internal Server Error"
-        else:
-            self.code = 404
-            self.message = "Not Found"
-        
-        if self.fp: # path is inherently nonexistent
-            try:
-                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
-                self.locked = True
-            except IOError:
-                self.code = 500
-                self.message = "Internal Server Error"
+        baseserver.GETHandler.__init__(self, *args, **kwargs)
+        self.claimed = None # the path within the shred queue
+        self.decompressor = None
+        self.key = None # an encrypted drop's
+        self.pending = "" # decompressed, but not yet sent
+        self.ram = None
+        self.shred_job = None # set when the shred queue overflows
+        self.zerocopy = False # the kernel may still hold the pages we shred
 
-        try: # send response header
-            baseserver.HTTPRequestHandler.respond(self)
-        except socket.error: # the file will eventually be closed
-            self.locked = False
+        if self.code == 404: # not on disk, but perhaps in memory
+            self.ram = self.event.server.ram_tier.get(self.path)
+
+            if self.ram:
+                self.code = 200
+                self.message = "OK"
+
+    def deadline(self):
+        if self.ram and not self.responded: # waiting for the upload
+            return self.lock_retry.deadline
+        return baseserver.GETHandler.deadline(self)
+
+    def find(self, path):
+        """consult the server's index, if any, before the filesystem"""
+        server = self.event.server
+
+        if server.index == None:
+            return True
+        return path in server.index and not path in server.ram_tier
+
+    def interest(self):
+        if self.shred_job: # shredding it ourselves
+            return None
+        elif self.ram and not self.responded and self.lock_retry.deadline:
+            return self.event.conn.fileno(), 0 # retry at the deadline
+        elif self.ram and not self.responded: # waiting for the upload
+            return None
+        return baseserver.GETHandler.interest(self)
 
     def next(self):
-        if self.locked:
-            if self.content_length: # fp is inherently open
-                try:
-                    chunk = self.fp.read(
-                        baseserver.http_bufsize(self.content_length))
-                    self.content_length -= len(chunk)
-                    self.fp.seek(-len(chunk))
-                    self.fp.write(os.urandom(len(chunk)))
-                    self.fp.flush()
-                    os.fdatasync(self.fp.fileno())
-                except IOError:
-                    pass
-                
-                try:
-                    self.event.conn.sendall(chunk)
-                except IOError:
-                    pass
-                return
-            
+        if self.ram:
+            return self.next_ram()
+        elif self.shred_job:
+            started = time.time() if self.event.trace else None
+
             try:
-                fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
-            except IOError:
-                pass
-            self.locked = False
+                return self.shred_job.next()
+            except StopIteration:
+                self.shred_job = None
+                raise
+            finally:
+                if self.event.trace:
+                    self.event.trace.span("shred", started)
         
-        if self.fp: # may not have been locked
+        try:
+            return baseserver.GETHandler.next(self)
+        except StopIteration:
+            if not self.claimed:
+                raise
+            started = time.time() if self.event.trace else None
+            self.shred_job = self.event.server.dispose(self.claimed,
+                self.key)
+
+            if self.event.trace:
+                self.event.trace.span("dispose", started)
+            self.claimed = None
+            self.key = None
+
+            if not self.shred_job:
+                raise
+
+    def next_ram(self):
+        """send, then wipe, a drop from the RAM tier"""
+        ram_tier = self.event.server.ram_tier
+
+        if not self.responded:
+            if not self.ram.ready:
+                if ram_tier.get(self.path) is self.ram: # still uploading
+                    self.lock_retry.failed()
+                    return
+                self.ram = None # the upload failed
+            elif not ram_tier.claim(self.path, self.ram):
+                self.ram = None # a concurrent GET got to it first
+            else:
+                self.event.server.accounting.release(self.path)
+
+                if not self.event.server.index == None:
+                    self.event.server.index.remove(self.path)
+
+            if self.ram:
+                self.content_length = self.ram.size
+                self.headers["content-length"] = self.content_length
+            else:
+                self.code = 404
+                self.message = "Not Found"
+            self.responded = True
+
             try:
-                self.fp.close()
-            except (IOError, OSError):
-                pass
-            self.fp = None
+                baseserver.HTTPRequestHandler.respond(self)
+                self.active = time.time()
+            except socket.error:
+                self.content_length = 0
+                self.headers["connection"] = "close"
+            return
 
+        if self.content_length > 0:
             try:
-                os.unlink(self.path)
-            except OSError:
-                pass
+                sent = self.send()
+            except socket.timeout: # the socket buffer is full
+                if not self.stalled():
+                    return
+                sent = 0
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) \
+                        and not self.stalled():
+                    return
+                sent = 0
+
+            if sent:
+                self.active = time.time()
+                self.content_length -= sent
+                self.event.sent += sent
+                self.offset += sent
+                return
+            self.content_length = 0 # the peer is gone
+            self.headers["connection"] = "close"
+        ram_tier.release(self.ram)
+        self.ram = None
         raise StopIteration()
 
+    def opened(self):
+        """claim the file, unless a concurrent GET got to it first"""
+        started = time.time() if self.event.trace else None
+        self.claimed = self.event.server.claim(self.path, self.fp)
+
+        if self.event.trace:
+            self.event.trace.span("claim", started)
+
+        if not self.claimed:
+            self.code = 404
+            self.message = "Not Found"
+            self.fp.close()
+            self.fp = None
+            self.locked = False
+            return
+        self.key = self.event.server.keys.pop(self.path)
+        baseserver.GETHandler.opened(self)
+
+        if self.key:
+            self.fp = cryptoerase.EncryptedFile(self.fp,
+                self.key.keystream())
+            self.content_length -= len(cryptoerase.MAGIC)
+            self.headers["content-length"] = self.content_length
+
+        if self.content_length < compress.HEADER_SIZE: # stored as is
+            return
+        info = compress.header(self.fp)
+
+        if info:
+            self.content_length = info[1]
+            self.headers["content-length"] = self.content_length
+            self.offset = compress.HEADER_SIZE
+
+            if info[0] == compress.DEFLATED:
+                self.decompressor = compress.Decompressor(self.fp)
+
+    def send(self):
+        if not self.decompressor and not self.ram:
+            return baseserver.GETHandler.send(self)
+        trace = self.event.trace
+        started = time.time() if trace else None
+
+        if self.ram:
+            data = self.ram.read(self.offset,
+                self.chunk_sizer(self.content_length))
+        else:
+            if not self.pending:
+                try:
+                    self.pending = self.decompressor.read(
+                        self.chunk_sizer(self.content_length))
+                except zlib.error: # corrupt (treated as truncated)
+                    return 0
+
+                if trace:
+                    trace.span("read", started)
+                    started = time.time()
+            data = self.pending
+        sent = self.event.conn.send(data)
+        self.pending = self.pending[sent:]
+        self.chunk_sizer.update(sent)
+
+        if trace:
+            trace.span("send", started)
+        return sent
+
+class HEADHandler(baseserver.HEADHandler):
+    """
+    identical to its parent, though with a drop index,
+    it's answered from the index alone (waiting out an upload in progress),
+    and without one, drops in the RAM tier are found too
+
+    an incomplete resumable upload is answered with 202,
+    and its length and the octets received so far
+    (X-Upload-Length and X-Upload-Offset)
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.entry = None
+        baseserver.HEADHandler.__init__(self, *args, **kwargs)
+
+        if self.entry:
+            self.code = 200
+            self.message = "OK"
+        elif self.code == 404:
+            ram = self.event.server.ram_tier.get(self.event.server.resolve(
+                self.event.request.resource))
+
+            if ram and ram.ready:
+                self.code = 200
+                self.headers["content-length"] = ram.size
+                self.message = "OK"
+
+    def deadline(self):
+        if self.entry: # waiting for the upload
+            return self.lock_retry.deadline
+        return baseserver.HEADHandler.deadline(self)
+
+    def find(self, path):
+        """note the drop's index entry, if there's an index"""
+        server = self.event.server
+
+        if server.index == None:
+            return True
+        self.entry = server.index.get(path)
+
+        if self.entry and self.entry[1] == index.DropIndex.FETCHING:
+            self.entry = None
+        return False
+
+    def interest(self):
+        if self.entry and self.lock_retry.deadline:
+            return self.event.conn.fileno(), 0 # retry at the deadline
+        elif self.entry: # waiting for the upload
+            return None
+        return baseserver.HEADHandler.interest(self)
+
+    def next(self):
+        if self.entry:
+            if not self.event.server.index.get(self.path) is self.entry \
+                    or self.entry[1] == index.DropIndex.FETCHING:
+                self.code = 404
+                self.message = "Not Found"
+            elif self.entry[1] == index.DropIndex.UPLOADING:
+                self.lock_retry.failed()
+                return # try again later
+            elif self.entry[1] == index.DropIndex.INCOMPLETE:
+                upload = self.event.server.partials.get(self.path)
+
+                if upload:
+                    self.code = 202
+                    self.headers["x-upload-length"] = upload.length
+                    self.headers["x-upload-offset"] = upload.received
+                    self.message = "Accepted"
+                else:
+                    self.code = 404
+                    self.message = "Not Found"
+            else:
+                self.headers["content-length"] = self.entry[0]
+            self.entry = None
+        baseserver.HEADHandler.next(self)
+
+    def size(self):
+        """report a drop stored compressed by its original size"""
+        size = baseserver.HEADHandler.size(self)
+
+        if size >= compress.HEADER_SIZE:
+            info = compress.header(self.fp)
+
+            if info:
+                return info[1]
+        return size
+
 class POSTHandler(baseserver.HTTPRequestHandler):
+    """
+    store a file
+
+    when the server's configuration enables SPLICE (and the platform
+    supports it), the body moves from the socket to the file through
+    a pipe, never entering user space
+
+    the declared length is reserved with the server's accounting
+    before the file is created, and a failed upload's file is removed
+
+    with COMPRESSION, the body is compressed as it's written
+    (see compress.Compressor); sizes reported and checked against
+    limits are the original ones, but the accounting is charged
+    for what's stored; either way, a body that begins like a header
+    (compress.MAGIC, or cryptoerase.MAGIC) is stored after a STORED
+    header, so it's never misread (resumable uploads always have one)
+
+    with CRYPTO_ERASE, what's written (after compression) is encrypted
+    under a new key, kept by the server (see cryptoerase.KeyStore),
+    and a failed upload's key is wiped
+
+    a chunked body (Transfer-Encoding: chunked) is decoded as it arrives,
+    and its reservation grows with it; once it exceeds MAX_CHUNKED_SIZE
+    (or MAX_DROP_SIZE), the upload ends with 413
+
+    small drops may go to the server's RAM tier instead
+    (they're never synced, and there's nothing to lock:
+    they can't be fetched until they're complete)
+
+    with a drop index, the upload is indexed before anything else
+    (a path already indexed is a conflict), marked ready once it's stored,
+    and unindexed if it fails
+
+    the drop expires after the server's TTL, or the one in the X-TTL header
+    (limited to MAX_TTL); the TTL in effect is returned in the same header
+
+    with a drop index, an upload may be resumable: each piece is sent
+    with Content-Range ("bytes FIRST-LAST/LENGTH"), and the first
+    (from 0) starts it; the pieces accumulate in the shred directory,
+    where GETs can't reach them (and where they're shredded after
+    RESUME_TIMEOUT idle seconds, or a restart), until LENGTH octets
+    are there, and the drop is moved into place
+
+    a piece that leaves the drop incomplete is answered with 202,
+    and what arrived is kept even when a piece fails; the next piece
+    must start at X-Upload-Offset (see HEADHandler), or it's refused
+    with 416
+
+    a body that stalls for INACTIVE_TIMEOUT seconds ends the upload
+    with 408 (see baseserver.HTTPRequestHandler.stalled)
+
+    when traced, the lock wait, receiving (recv and write, or splice),
+    compression's final flush, and syncs are recorded as phases
+    """
+
+    CONSUMES_BODY = True # unless it fails (see next)
+    
     def __init__(self, *args, **kwargs):
         baseserver.HTTPRequestHandler.__init__(self, *args, **kwargs)
-        self.content_length = -1
+        config = self.event.server.sock_config
+        headers = self.event.request.headers
+        self.allowance = 0 # octets reserved for a chunked body
+        self.cap = None # on a chunked body's size
+        self.chunked = None # a ChunkedReader
+        self.compressor = None
+        self.content_length = -1 # unknown for a chunked body
+        self.key = None # with CRYPTO_ERASE
+        self.lock_retry = baseserver.Backoff()
+        self.lock_wait = None # when the lock was first tried (if tracing)
+        self.range = None # (first, last, length) of a resumable upload
+        self.upload = None # the PartialUpload this piece belongs to
         
-        try:
-            self.content_length = self.event.request.headers["content-length"]
-        except KeyError:
-            self.code = 411
-            self.message = "Length Required"
+        if "transfer-encoding" in headers:
+            if not headers.tokens("transfer-encoding") == ["chunked"]:
+                self.code = 501
+                self.message = "Not Implemented"
+            elif "content-length" in headers: # ambiguous
+                self.code = 400
+                self.message = "Bad Request"
+            else:
+                self.chunked = baseserver.ChunkedReader(self.event.reader)
+
+                for cap in (config.MAX_CHUNKED_SIZE, config.MAX_DROP_SIZE):
+                    if not cap == None:
+                        self.cap = cap if self.cap == None \
+                            else min(self.cap, cap)
+        else:
+            try:
+                self.content_length = headers["content-length"]
+            except KeyError:
+                self.code = 411
+                self.message = "Length Required"
+
+            if self.code == 200 and (self.content_length < 0
+                    or not isinstance(self.content_length, (int, long))):
+                self.code = 400
+                self.content_length = -1
+                self.message = "Bad Request"
+
+        if not self.code == 200 or not "content-range" in headers:
+            pass
+        elif self.event.server.index == None:
+            self.code = 501
+            self.message = "Not Implemented"
+        else:
+            try:
+                self.range = partial.parse_content_range(
+                    headers["content-range"])
+
+                if self.chunked or not self.content_length \
+                        == self.range[1] - self.range[0] + 1:
+                    raise baseserver.HTTPError(400, "Bad Request")
+            except baseserver.HTTPError as e:
+                self.code = e.code
+                self.message = e.message
+        self.ttl = self.event.server.sock_config.TTL
+
+        if "x-ttl" in self.event.request.headers:
+            self.ttl = self.event.request.headers["x-ttl"]
+
+            if not isinstance(self.ttl, (float, int, long)) \
+                    or not 0 < self.ttl < float("inf"):
+                self.code = 400
+                self.message = "Bad Request"
+                self.ttl = None
+
+        if self.ttl and not self.event.server.sock_config.MAX_TTL == None:
+            self.ttl = min(self.ttl, self.event.server.sock_config.MAX_TTL)
+
+        if self.ttl:
+            self.headers["x-ttl"] = self.ttl
         self.fp = None
+        self.indexed = False
         self.locked = False
+        self.chunk_sizer = baseserver.ChunkSizer(self.event.server.sock_config)
+        self.reserved = False
         self.path = self.event.server.resolve(self.event.request.resource)
+        self.pipe = None # (read fd, write fd, capacity) for splicing
+        self.ram = None
+        self.size = 0
+        self.stored = 0 # octets on disk, once the drop's stored
+        self.sync_policy = SyncPolicy(self.event.server.sock_config)
+        self.zerocopy = self.event.server.sock_config.SPLICE \
+            and bool(baseserver.zerocopy.splice) and not self.chunked
+        self.headers["x-durability"] = self.sync_policy.name
         
-        if os.path.exists(self.path):
+        if not self.code == 200: # nothing to receive
+            pass
+        elif self.range:
+            self.begin_piece()
+        elif self.conflicts():
             self.code = 409
             self.message = "Conflict"
-        elif self.content_length > -1: # we're actually receiving a file
+        else:
+            try: # (drops held in memory count, too)
+                self.event.server.accounting.reserve(self.path,
+                    self.event.remote[0],
+                    max(0, self.content_length)) # may reject
+            except baseserver.HTTPError:
+                if self.indexed:
+                    self.event.server.index.remove(self.path)
+                raise
+            self.reserved = True
+
+            if not self.chunked:
+                self.ram = self.event.server.ram_tier.reserve(self.path,
+                    self.content_length)
+
+            if self.ram:
+                self.headers["x-durability"] = "memory"
+                self.locked = True
+                return
+
             try:
                 self.fp = open(self.path, "wb")
+                self.lock() # before a concurrent GET can claim it empty
+
+                if config.CRYPTO_ERASE:
+                    self.encrypt(self.event.server.keys.create(self.path),
+                        True)
+            except (IOError, OSError) as e:
+                self.code = 500
+                self.message = "Internal Server Error"
+
+                if e.errno == errno.EISDIR:
+                    self.code = 409
+                    self.message = "Conflict"
+                return
+
+            # even uncompressed data is escaped when it'd be misread
+            # (as compressed, or as encrypted: see compress)
+            self.compressor = compress.Compressor(self.fp,
+                config.COMPRESSION, 65536 if config.COMPRESSION
+                    else len(compress.MAGIC),
+                escapes = (compress.MAGIC, cryptoerase.MAGIC))
+
+            if config.COMPRESSION:
+                self.zerocopy = False
+
+    def begin_piece(self):
+        """
+        start a piece of a resumable upload
+        (the first piece starts the upload itself)
+        """
+        server = self.event.server
+        first, last, length = self.range
+
+        if not first:
+            if not server.index.add(self.path, length):
+                self.code = 409
+                self.message = "Conflict"
+                return
+
+            try:
+                server.accounting.reserve(self.path, self.event.remote[0],
+                    length) # may reject
+                fd, temp = tempfile.mkstemp(prefix = "partial-",
+                    dir = server.partial_directory)
+            except (baseserver.HTTPError, OSError) as e:
+                server.accounting.abort(self.path)
+                server.index.remove(self.path)
+
+                if isinstance(e, baseserver.HTTPError):
+                    raise
+                self.code = 500
+                self.message = "Internal Server Error"
+                return
+            self.upload = server.partials.add(self.path, temp, length)
+            self.fp = os.fdopen(fd, "wb")
+            self.lock()
+
+            try: # the header keeps the data from being misread
+                if server.sock_config.CRYPTO_ERASE:
+                    self.encrypt(server.keys.create(self.path), True)
+                self.fp.write(compress.stored_header(length))
             except (IOError, OSError):
                 self.code = 500
                 self.message = "Internal Server Error"
-        
-        if self.fp: # path is inherently nonexistent
+            return
+        self.upload = server.partials.acquire(self.path) # may conflict
+
+        if not self.upload:
+            self.code = 404
+            self.message = "Not Found"
+            return
+        elif not self.upload.length == length:
+            self.code = 400
+            self.message = "Bad Request"
+        elif not self.upload.received == first:
+            self.code = 416
+            self.headers["content-range"] = "bytes */%u" % length
+            self.headers["x-upload-offset"] = self.upload.received
+            self.message = "Range Not Satisfiable"
+        else:
             try:
-                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
-                self.locked = True
-            except IOError:
+                self.fp = open(self.upload.temp, "r+b")
+                self.lock()
+                key = server.keys.get(self.path)
+
+                if key:
+                    self.encrypt(key)
+                self.fp.seek(0, os.SEEK_END)
+                server.index.mark(self.path, index.DropIndex.UPLOADING)
+                return
+            except (IOError, OSError):
                 self.code = 500
                 self.message = "Internal Server Error"
+
+                if self.fp:
+                    self.fp.close()
+                    self.fp = None
+        server.partials.release(self.upload, self.upload.deadline)
+        self.upload = None
+
+    def conflicts(self):
+        """return whether path is taken (if not, it's indexed, if need be)"""
+        drop_index = self.event.server.index
+
+        if drop_index == None:
+            return os.path.exists(self.path) \
+                or self.path in self.event.server.ram_tier
+        self.indexed = drop_index.add(self.path, max(0, self.content_length))
+        return not self.indexed
+
+    def deadline(self):
+        if self.fp and not self.locked and self.code == 200: # retrying
+            return self.lock_retry.deadline
+        return baseserver.HTTPRequestHandler.deadline(self)
+
+    def end_piece(self):
+        """
+        finish a piece of a resumable upload: move the drop into place
+        once it's complete, or else keep what arrived for the next piece
+        """
+        server = self.event.server
+        upload = self.upload
+        self.upload = None
+        renamed = False
+
+        try:
+            self.fp.flush()
+            self.fp.seek(0, os.SEEK_END)
+            upload.received = self.fp.tell() - compress.HEADER_SIZE
+            stored = os.fstat(self.fp.fileno()).st_size
+
+            if self.code == 200 and upload.received == upload.length:
+                if self.sync_policy.due_final():
+                    self.sync()
+                os.rename(upload.temp, self.path)
+                renamed = True
+
+                if self.sync_policy.due_final():
+                    self.sync_directory()
+                server.partials.remove(upload)
+                server.index.ready(self.path, upload.length, stored)
+                server.accounting.commit(self.path, stored)
+                server.sprint(server.PREFIX, "Stored", self.path,
+                    "(%u octets, resumable, durability: %s)"
+                        % (upload.length, self.sync_policy.name))
+                return
+            elif self.code == 200:
+                if self.sync_policy.due_final():
+                    self.sync()
+                self.code = 202
+                self.headers["x-upload-offset"] = upload.received
+                self.message = "Accepted"
+        except (IOError, OSError):
+            self.code = 500
+            self.message = "Internal Server Error"
+
+            if renamed:
+                self.remove()
+            server.abandon(upload)
+            return
+        finally:
+            try:
+                self.fp.close()
+            except (IOError, OSError):
+                pass
+            self.fp = None
+        server.index.mark(self.path, index.DropIndex.INCOMPLETE)
+        deadline = time.time() + server.sock_config.RESUME_TIMEOUT
+        server.partials.release(upload, deadline)
+        server.expiry.schedule(deadline, self.path, upload)
+
+    def encrypt(self, key, create = False):
+        """
+        encrypt what's written to the file from now on under key
+        (see cryptoerase.EncryptedFile)
+        """
+        self.key = key
+        self.fp = cryptoerase.EncryptedFile(self.fp, key.keystream(), create)
+        self.zerocopy = False
+
+    def expire_later(self):
+        """schedule the stored drop's expiry"""
+        server = self.event.server
+
+        if self.ram:
+            token = self.ram
+        elif not server.index == None:
+            token = server.index.get(self.path)
+        else:
+            try:
+                token = os.fstat(self.fp.fileno()).st_mtime
+            except OSError:
+                return
+        server.expiry.schedule(time.time() + self.ttl, self.path, token)
+
+    def grow(self, octets):
+        """
+        make sure a chunked body's reservation covers octets more,
+        at least doubling it when it doesn't (up to the cap)
+
+        raises an HTTPError like Accounting.extend
+        """
+        needed = self.size + octets - self.allowance
+
+        if needed <= 0:
+            return
+        extension = max(needed, self.allowance)
+
+        if not self.cap == None:
+            extension = max(needed, min(extension, self.cap - self.allowance))
+        self.event.server.accounting.extend(self.path, extension)
+        self.allowance += extension
+
+    def interest(self):
+        """wait for the lock, then body octets, then the chance to respond"""
+        if self.fp and not self.locked and self.code == 200 \
+                and self.lock_retry.deadline: # retrying the lock
+            return self.event.conn.fileno(), 0 # retry at the deadline
+        elif self.fp and not self.locked and self.code == 200:
+            return None
+        elif self.locked and self.content_length \
+                and not (self.chunked.ready() if self.chunked
+                    else self.event.reader.buffered()):
+            return self.event.conn.fileno(), baseserver.polling.READ
+        return baseserver.HTTPRequestHandler.interest(self)
     
+    def lock(self):
+        """
+        try to lock the file, backing off (see interest) when it's contended
+        """
+        trace = self.event.trace
+
+        if trace and self.lock_wait == None:
+            self.lock_wait = time.time()
+
+        try:
+            if not baseserver.try_flock(self.fp.fileno()):
+                self.lock_retry.failed()
+                return
+            self.active = time.time()
+            self.locked = True
+
+            if trace:
+                trace.span("lock", self.lock_wait)
+        except IOError:
+            self.code = 500
+            self.message = "Internal Server Error"
+
     def next(self):
+        trace = self.event.trace
+
+        if self.fp and not self.locked and self.code == 200: # retrying
+            self.lock()
+
+            if self.locked or self.code == 200: # (else, clean up)
+                return
+        
         if self.locked:
             if self.content_length: # fp is inherently open
                 try:
-                    chunk = self.event.conn.recv(
-                        baseserver.http_bufsize(self.content_length))
-                    self.content_length -= len(chunk)
-                except socket.error:
-                    return
+                    received = self.receive()
+                except socket.timeout: # nothing yet
+                    if not self.stalled():
+                        return
+                    received = None
+                    self.code = 408
+                    self.message = "Request Timeout"
+                except (EOFError, socket.error):
+                    received = 0
+                except baseserver.HTTPError as e: # from a chunked body
+                    received = None
+                    self.code = e.code
+                    self.message = e.message
+                except (IOError, OSError) as e:
+                    received = -1
+
+                    if e.errno in (errno.EDQUOT, errno.ENOSPC):
+                        received = -2
+
+                if received == None:
+                    pass
+                elif not received and self.chunked and self.chunked.done():
+                    self.content_length = 0 # that was the last chunk
+                elif not received: # the client hung up early
+                    self.code = 400
+                    self.message = "Bad Request"
+                elif received > 0:
+                    self.active = time.time()
+
+                    if not self.chunked:
+                        self.content_length -= received
+                    self.size += received
 
+                    try:
+                        if self.fp:
+                            self.fp.flush()
+
+                            if self.content_length \
+                                    and self.sync_policy.due(received):
+                                self.sync()
+                        self.chunk_sizer.update(received)
+                        return
+                    except (IOError, OSError):
+                        self.code = 500
+                        self.message = "Internal Server Error"
+                elif received == -2:
+                    self.code = 507
+                    self.message = "Insufficient Storage"
+                else:
+                    self.code = 500
+                    self.message = "Internal Server Error"
+            
+            if self.upload: # a piece of a resumable upload
+                self.end_piece()
+            elif self.code == 200 and self.ram: # the whole body is in memory
+                self.event.server.accounting.commit(self.path, self.size)
+                self.reserved = False
+                self.ram.ready = True # (only now can it be released)
+                self.event.server.sprint(self.event.server.PREFIX,
+                    "Stored", self.path, "(%u octets, in memory)" % self.size)
+            elif self.code == 200: # the whole body is in the file
                 try:
-                    self.fp.write(chunk)
-                    self.fp.flush()
-                    os.fdatasync(self.fp.fileno())
-                    return
-                except IOError:
+                    if self.compressor:
+                        started = time.time() if trace else None
+                        self.compressor.close()
+
+                        if trace:
+                            trace.span("compress", started)
+                    self.fp.flush() # (spliced octets bypass the compressor)
+                    self.stored = os.fstat(self.fp.fileno()).st_size
+
+                    if self.sync_policy.due_final():
+                        self.sync(True)
+                    self.event.server.sprint(self.event.server.PREFIX,
+                        "Stored", self.path, "(%u octets, %u on disk,"
+                            " durability: %s, %u syncs)" % (self.size,
+                                self.stored, self.sync_policy.name,
+                                self.sync_policy.syncs))
+                except (IOError, OSError):
                     self.code = 500
                     self.message = "Internal Server Error"
+
+            if self.indexed and self.code == 200: # before it can be fetched
+                self.event.server.index.ready(self.path, self.size,
+                    self.stored)
+                self.indexed = False
+
+            if self.code == 200 and self.ttl:
+                self.expire_later()
             
-            try:
-                fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
-            except IOError:
-                pass
+            if self.fp:
+                try:
+                    fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+                except IOError:
+                    pass
             self.locked = False
+
+        if self.upload: # it never got as far as the lock
+            self.end_piece()
+
+        if self.ram:
+            if not self.code == 200:
+                self.event.server.ram_tier.discard(self.path, self.ram)
+            self.ram = None
         
         if self.fp: # may not have been locked
+            if not self.code == 200:
+                self.remove()
+
+                if self.key and not self.range:
+                    self.event.server.keys.destroy(self.path, self.key)
+
             try:
                 self.fp.close()
             except (IOError, OSError):
                 pass
             self.fp = None
+
+        if self.indexed: # the upload failed
+            self.event.server.index.remove(self.path)
+            self.indexed = False
+
+        if self.reserved:
+            if self.code == 200:
+                self.event.server.accounting.commit(self.path, self.stored)
+            else:
+                self.event.server.accounting.abort(self.path)
+            self.reserved = False
+
+        if self.pipe:
+            for fd in self.pipe[:2]:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            self.pipe = None
+
+        if self.content_length: # part of the body (if any) is still unread
+            self.headers["connection"] = "close"
         baseserver.HTTPRequestHandler.next(self) # respond/stop
 
-for k, v in (("GET", GETHandler), ("POST", POSTHandler)):
+    def receive(self):
+        """
+        move part of the body into the file, and return the amount
+        (0 once the client hangs up, or after a chunked body's last chunk)
+
+        raises socket.timeout when nothing is ready,
+        socket.error (or EOFError) for connection errors,
+        HTTPError for a malformed or oversized chunked body,
+        and IOError/OSError for file errors
+        """
+        trace = self.event.trace
+        started = time.time() if trace else None
+
+        if self.chunked:
+            chunk = self.chunked.recv(self.chunk_sizer(self.chunk_sizer.max))
+
+            if not self.cap == None and self.size + len(chunk) > self.cap:
+                raise baseserver.HTTPError(413, "Payload Too Large")
+            self.grow(len(chunk))
+        elif self.zerocopy and not self.ram \
+                and not self.event.reader.buffered() \
+                and (not self.compressor or self.compressor.passthrough()):
+            received = self.splice(self.chunk_sizer(self.content_length))
+
+            if trace:
+                trace.span("splice", started)
+            return received
+        else:
+            chunk = self.event.reader.recv(self.chunk_sizer(
+                self.content_length))
+
+        if trace:
+            trace.span("recv", started)
+            started = time.time()
+
+        if self.ram:
+            written = self.ram.write(chunk)
+        else:
+            self.write(chunk)
+            written = len(chunk)
+
+        if trace:
+            trace.span("write", started)
+        return written
+
+    def write(self, data):
+        """write body octets to the file (through the compressor, if any)"""
+        if self.compressor:
+            self.compressor.write(data)
+        else:
+            self.fp.write(data)
+
+    def remove(self):
+        """unlink the (partial) file, unless it's since been replaced"""
+        try:
+            if os.path.samestat(os.fstat(self.fp.fileno()),
+                    os.stat(self.path)):
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    def sync(self, final = False):
+        """
+        sync the file's data to disk
+        (and once the drop is complete, its directory entry)
+        """
+        self.fp.flush()
+        started = time.time()
+        os.fdatasync(self.fp.fileno())
+        synced = time.time()
+        self.event.server.metrics["fdatasync_duration_seconds"].observe(
+            synced - started, ("upload", ))
+
+        if self.event.trace:
+            self.event.trace.span("fdatasync", started, synced)
+
+        if final:
+            self.sync_directory()
+
+            if self.event.trace:
+                self.event.trace.span("fsync_directory", synced)
+        self.sync_policy.synced()
+
+    def sync_directory(self):
+        """sync the directory holding path (and so its entry)"""
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def splice(self, size):
+        """move body octets from the socket to the file through a pipe"""
+        zerocopy = baseserver.zerocopy
+
+        if not self.pipe:
+            self.pipe = zerocopy.pipe(self.chunk_sizer.max)
+
+        try:
+            received = zerocopy.splice(self.event.conn.fileno(), self.pipe[1],
+                min(size, self.pipe[2]),
+                flags = zerocopy.SPLICE_F_MOVE | zerocopy.SPLICE_F_NONBLOCK)
+        except OSError as e:
+            if e.errno in zerocopy.UNSUPPORTED: # use the fallback from now on
+                self.zerocopy = False
+            elif not e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise socket.error(e.errno, e.strerror)
+            raise socket.timeout()
+        moved = 0
+
+        while moved < received: # drain the pipe (appending to the file)
+            spliced = zerocopy.splice(self.pipe[0], self.fp.fileno(),
+                received - moved, flags = zerocopy.SPLICE_F_MOVE)
+
+            if not spliced:
+                raise IOError(errno.EIO, "splice moved nothing")
+            moved += spliced
+        self.event.reader.received += received # it bypassed the reader
+        return received
+
+for k, v in (("GET", GETHandler), ("HEAD", HEADHandler),
+        ("POST", POSTHandler)):
     baseserver.HTTPConnectionHandler.METHOD_TO_HANDLER[k] = v
 
+class SyncPolicy:
+    """
+    decide when an upload is synced to disk
+
+    the policy is named by SDropConfig.DURABILITY:
+        CHUNK: after every chunk (the safest, and slowest)
+        PERIODIC: every SYNC_BYTES octets or SYNC_INTERVAL seconds,
+            and before responding
+        ONCE: before responding, so a 200 means the drop is durable
+        NONE: never (the kernel writes it back eventually)
+    """
+
+    CHUNK = "chunk"
+    NONE = "none"
+    ONCE = "once"
+    PERIODIC = "periodic"
+    POLICIES = (CHUNK, NONE, ONCE, PERIODIC)
+
+    def __init__(self, config):
+        if not config.DURABILITY in SyncPolicy.POLICIES:
+            raise ValueError("unknown durability policy: %s"
+                % repr(config.DURABILITY))
+        self.name = config.DURABILITY
+        self.sync_bytes = config.SYNC_BYTES
+        self.sync_interval = config.SYNC_INTERVAL
+        self.syncs = 0
+        self.unsynced = 0
+        self._last = time.time()
+
+    def due(self, written):
+        """account for newly written octets, and return whether to sync"""
+        self.unsynced += written
+
+        if self.name == SyncPolicy.CHUNK:
+            return True
+        elif self.name == SyncPolicy.PERIODIC:
+            return self.unsynced >= self.sync_bytes \
+                or time.time() - self._last >= self.sync_interval
+        return False
+
+    def due_final(self):
+        """return whether to sync before responding"""
+        return not self.name == SyncPolicy.NONE
+
+    def synced(self):
+        """note that a sync happened"""
+        self.syncs += 1
+        self.unsynced = 0
+        self._last = time.time()
+
+class SDropConfig(baseserver.HTTPConfig):
+    """
+    sdrop configuration
+
+    CAPACITY: the most octets the root may hold
+        (including uploads in progress, and drops awaiting shredding)
+    CLIENT_QUOTA: the most octets each client address may have stored
+        (or be uploading)
+    COMPRESSION: the zlib level (1-9) drops are compressed with at rest,
+        or 0 to store them as is; data that doesn't compress is stored
+        as is regardless, as are drops in the RAM tier and resumable
+        uploads, and compressed uploads can't use SPLICE
+        (drops stored compressed are always decompressed when fetched)
+    CRYPTO_ERASE: encrypt drops at rest, each under its own random key
+        held only in memory (see cryptoerase), so a fetched or expired
+        drop is erased by wiping its key, and merely unlinked rather
+        than shredded; keys don't survive a restart, so encrypted drops
+        found on startup are shredded, and PROCESSES must be 1
+        (encrypted uploads can't use SPLICE)
+    DURABILITY: when uploads are synced to disk (see SyncPolicy)
+    MAX_CHUNKED_SIZE: the largest chunked upload accepted
+        (its length isn't known up front)
+    MAX_DROP_SIZE: the largest drop accepted
+    MAX_TTL: the longest TTL a client may ask for (see TTL)
+    MIN_FREE: octets always left free on the root's filesystem
+    PARTIAL_DIRECTORY: where incomplete resumable uploads are kept,
+        relative to the root (it's never served, and whatever's left in it
+        on startup is shredded)
+    PROCESSES: the number of worker processes (see baseserver.Prefork);
+        each has its own threads, shredders, limits, accounting
+        and metrics (served on a port of its own: see baseserver.HTTPConfig)
+        (though MIN_FREE is checked against the filesystem itself),
+        so the RAM tier can't be used, and there's no drop index
+        (see index.DropIndex): every request checks the filesystem,
+        and uploads can't be resumed
+    RAM_BUDGET: octets of locked memory for small drops (see RAMTier);
+        they're never on disk, regardless of DURABILITY (0 disables this)
+    RAM_MAX_DROP: the largest drop kept in memory
+    RESUME_TIMEOUT: seconds an incomplete resumable upload
+        (see POSTHandler) waits for its next piece
+    SHRED_DIRECTORY: the shred queues, relative to the root
+        (it's never served): each worker (see PROCESSES) has its own,
+        named by its number, and shreds what's left in it on startup;
+        worker 0 also takes whatever no worker would
+        (see SDropServer.orphans)
+    SHRED_PATTERN: what drops are overwritten with (see shred.PATTERNS)
+    SHRED_QUEUE: how many fetched drops may wait to be shredded;
+        beyond that, GETs shred their own drops
+    SHRED_RATE: the shredders' combined limit, in octets per second
+    SHRED_THREADS: the number of shredders
+    SPLICE: ingest POST bodies with splice (zero-copy), when available
+    SYNC_BYTES, SYNC_INTERVAL: the periodic durability policy's bounds
+    TTL: seconds after which an unfetched drop is shredded (None for never);
+        clients may ask for another with the X-TTL header, though
+        drops found on startup are given this one (counting from
+        their modification times)
+    """
+    
+    CAPACITY = None
+    CLIENT_QUOTA = None
+    COMPRESSION = 0
+    CRYPTO_ERASE = False
+    DURABILITY = SyncPolicy.CHUNK
+    MAX_CHUNKED_SIZE = 1073741824
+    MAX_DROP_SIZE = None
+    MAX_TTL = None
+    METRICS_NAMESPACE = "sdrop"
+    MIN_FREE = 67108864
+    PARTIAL_DIRECTORY = ".partial"
+    PROCESSES = 1
+    RAM_BUDGET = 0
+    RAM_MAX_DROP = 65536
+    RESUME_TIMEOUT = 3600
+    SHRED_DIRECTORY = ".shred"
+    SHRED_PATTERN = "keystream"
+    SHRED_QUEUE = 1024
+    SHRED_RATE = None
+    SHRED_THREADS = 2
+    SPLICE = False
+    SYNC_BYTES = 67108864
+    SYNC_INTERVAL = 1
+    TTL = None
+
 class SDropServer(baseserver.BaseHTTPServer):
-    def __init__(self, *args, **kwargs):
-        baseserver.BaseHTTPServer.__init__(self, *args, **kwargs)
+    """
+    an HTTP server for drops (see the handlers above)
+
+    besides its parent's metrics, it keeps fdatasync latency,
+    the octets shredded, and the state of its storage, RAM tier,
+    expiry queue, resumable uploads and keys
+    """
+
+    def __init__(self, handler_class = baseserver.HTTPConnectionHandler,
+            isolate = True, root = os.getcwd(), sock_config = SDropConfig,
+            *args, **kwargs):
+        if not isinstance(sock_config(), SDropConfig):
+            raise TypeError("sock_config must inherit from SDropConfig")
+        SyncPolicy(sock_config) # validate DURABILITY
+
+        if sock_config.PROCESSES > 1 and sock_config.RAM_BUDGET:
+            raise ValueError("the RAM tier can't be shared between processes")
+        elif sock_config.PROCESSES > 1 and sock_config.CRYPTO_ERASE:
+            raise ValueError("keys can't be shared between processes")
+        baseserver.BaseHTTPServer.__init__(self, handler_class, isolate, root,
+            sock_config, *args, **kwargs)
+        self.partial_directory = os.path.normpath(os.path.join(self.root,
+            self.sock_config.PARTIAL_DIRECTORY))
+        self.shred_directory = os.path.normpath(os.path.join(self.root,
+            self.sock_config.SHRED_DIRECTORY))
+
+        try:
+            os.makedirs(self.partial_directory, 0700)
+        except OSError as e: # (another process may have made it)
+            if not e.errno == errno.EEXIST:
+                raise
+        leftovers = [os.path.join(self.partial_directory, name)
+            for name in os.listdir(self.partial_directory)] # (a restart's)
+        self.index = index.DropIndex(self.root,
+            (self.partial_directory, self.shred_directory),
+            cryptoerase.original_size if self.sock_config.CRYPTO_ERASE
+                else compress.original_size)
+        self.accounting = accounting.Accounting(self.root,
+            self.shred_directory,
+            self.sock_config.CAPACITY, self.sock_config.CLIENT_QUOTA,
+            self.sock_config.MAX_DROP_SIZE, self.sock_config.MIN_FREE,
+            self.index)
+        discarded = self.index.discarded # encrypted under a lost key
+        found = self.index.entries.items() # drops already stored
+
+        if self.sock_config.PROCESSES > 1: # the others' drops aren't in it
+            self.index = None
+        fdatasync = self.metrics.histogram("fdatasync_duration_seconds",
+            "seconds spent in fdatasync, for uploads and for shredding",
+            ("purpose", )) # (before any shredding)
+        queue = os.path.join(self.shred_directory,
+            str(self.worker)) # so no other worker recovers its claims
+        self.shredder = shred.Shredder(queue,
+            self.sock_config.SHRED_THREADS, self.sock_config.SHRED_QUEUE,
+            self.sock_config.SHRED_RATE,
+            pattern = self.sock_config.SHRED_PATTERN,
+            unlinked = self.accounting.unlinked,
+            synced = lambda seconds: fdatasync.observe(seconds, ("shred", )))
+
+        if not self.worker:
+            leftovers += self.orphans()
+
+        for path in discarded + leftovers:
+            try:
+                claimed = self.shredder.claim(path)
+            except OSError:
+                continue
+            self.accounting.claim(path, claimed)
+            job = self.shredder.put(claimed)
+
+            if job: # the queue is full
+                job()
+        self.ram_tier = ramtier.RAMTier(self.sock_config.RAM_BUDGET,
+            self.sock_config.RAM_MAX_DROP)
+        self.expiry = expiry.Expiry(self.expire)
+        self.keys = cryptoerase.KeyStore()
+        self.partials = partial.PartialUploads()
+
+        if self.sock_config.TTL:
+            for path, entry in found:
+                self.expiry.schedule(entry[2] + self.sock_config.TTL, path,
+                    entry[2] if self.index == None else entry)
+        self._register_metrics()
+        resolve = self.resolve
+        self.resolve = lambda r: self._hide_internals(resolve(r))
+
+    def abandon(self, upload, idle = False):
+        """
+        give up on an incomplete upload (if idle is set, only one that's
+        been idle past its deadline), disposing of what arrived,
+        and return whether it was still there
+        """
+        if not self.partials.remove(upload, idle):
+            return False
+
+        if not self.index == None:
+            self.index.remove(upload.path)
+        self.accounting.abort(upload.path)
+        key = self.keys.pop(upload.path)
+
+        try: # (so a crash can't leave it behind)
+            claimed = self.shredder.claim(upload.temp)
+        except OSError:
+            if key:
+                key.wipe()
+            return True
+        self.accounting.claim(upload.path, claimed)
+        job = self.dispose(claimed, key)
+
+        if job: # the queue is full
+            job()
+        return True
+
+    def claim(self, path, fp):
+        """
+        claim a drop, opened (and locked) as fp, for shredding,
+        and return its path within the shred queue,
+        or None if it's gone (e.g. a concurrent GET got to it first)
+
+        with a drop index, it's claimed from the index first;
+        otherwise, fp must still be the file at path
+        """
+        if self.index == None:
+            try:
+                current = os.stat(path)
+            except OSError:
+                return None
+
+            if not os.path.samestat(os.fstat(fp.fileno()), current):
+                return None
+        elif not self.index.claim(path): # only a stored drop can be claimed
+            return None
+
+        try:
+            claimed = self.shredder.claim(path)
+        except OSError:
+            if not self.index == None: # it's still there
+                self.index.mark(path, index.DropIndex.READY)
+            raise
+        self.accounting.claim(path, claimed)
+
+        if not self.index == None:
+            self.index.remove(path)
+        return claimed
+
+    def cleanup(self):
+        baseserver.BaseHTTPServer.cleanup(self)
+        self.expiry.kill()
+        self.shredder.kill_all()
+
+    def dispose(self, claimed, key = None):
+        """
+        get rid of a claimed drop: an encrypted one (given its key)
+        is erased by wiping the key, then unlinked; any other is queued
+        for shredding, returning the ShredJob when the queue is full
+        (see shred.Shredder.put)
+        """
+        if key == None:
+            return self.shredder.put(claimed)
+        key.wipe()
+
+        try:
+            os.unlink(claimed)
+        except OSError:
+            pass
+        self.accounting.unlinked(claimed)
+
+    def expire(self, path, token):
+        """
+        dispose of a drop whose TTL has passed, as a GET would have,
+        unless it's since gone (token identifies the drop that was scheduled:
+        a RAMDrop, an index entry, or a modification time)
+
+        incomplete uploads (when token is a PartialUpload) are abandoned
+        instead, unless they've been resumed
+        """
+        if isinstance(token, partial.PartialUpload):
+            if self.abandon(token, True):
+                self.sprint(self.PREFIX, "Abandoned", path,
+                    "(incomplete after %u of %u octets)"
+                        % (token.received, token.length))
+            return
+        ram = self.ram_tier.get(path)
+
+        if ram:
+            if ram is token and self.ram_tier.discard(path, ram):
+                self.accounting.release(path)
+
+                if not self.index == None:
+                    self.index.remove(path)
+                self.sprint(self.PREFIX, "Expired", path, "(in memory)")
+            return
+        elif not self.index == None:
+            entry = self.index.get(path)
+
+            if not entry is token or not entry[1] == index.DropIndex.READY:
+                return # replaced, or being fetched
+
+        try:
+            fp = open(path, "rb")
+        except IOError:
+            return
+        claimed = None
+
+        try:
+            if self.index == None \
+                    and not os.fstat(fp.fileno()).st_mtime == token:
+                return # replaced
+
+            if not baseserver.try_flock(fp.fileno()): # being fetched?
+                self.expiry.schedule(time.time() + 1, path, token)
+                return
+            claimed = self.claim(path, fp)
+        except (IOError, OSError) as e:
+            self.sprinte(self.ERROR_PREFIX, "Couldn't expire", path,
+                "(%s)" % e)
+        finally:
+            fp.close()
+
+        if claimed:
+            job = self.dispose(claimed, self.keys.pop(path))
+
+            if job: # the queue is full
+                job()
+            self.sprint(self.PREFIX, "Expired", path)
+
+    def _hide_internals(self, path):
+        """refuse access to the shred queues and incomplete uploads"""
+        normalized = os.path.normpath(path)
+
+        for directory in (self.partial_directory, self.shred_directory):
+            if normalized == directory \
+                    or normalized.startswith(directory + os.sep):
+                raise baseserver.HTTPError(404, "Not Found")
+        return path
+
+    def orphans(self):
+        """
+        return the paths of files in the shred directory that no worker
+        would recover: those in the queues of workers numbered PROCESSES
+        or above (from a run with more), and any outside a queue
+        """
+        orphans = []
+
+        try:
+            names = os.listdir(self.shred_directory)
+        except OSError:
+            return orphans
+
+        for name in names:
+            path = os.path.join(self.shred_directory, name)
+
+            if name.isdigit() and int(name) < self.sock_config.PROCESSES:
+                continue # a worker's own (it may be claiming into it now)
+            elif not os.path.isdir(path):
+                orphans.append(path)
+                continue
+
+            try:
+                orphans += [os.path.join(path, n) for n in os.listdir(path)]
+            except OSError:
+                pass
+        return orphans
+
+    def _register_metrics(self):
+        """add sdrop's own metrics"""
+        accounting = self.accounting
+        ram_tier = self.ram_tier
+        self.metrics.gauge("shredded_bytes_total", "octets overwritten",
+            lambda: self.shredder.overwritten, type = "counter")
+        self.metrics.gauge("shred_queue", "drops waiting to be shredded",
+            self.shredder.qsize)
+        self.metrics.gauge("storage_bytes", "octets under the root",
+            lambda: {("reserved", ): accounting.reserved,
+                ("stored", ): accounting.stored,
+                ("shredding", ): accounting.shredding_octets}, ("state", ))
+        self.metrics.gauge("ram_tier", "the RAM tier's statistics",
+            lambda: dict(((k, ), v) for k, v in ram_tier.stats().items()),
+            ("stat", ))
+        self.metrics.gauge("drops", "indexed drops (NaN without an index)",
+            lambda: None if self.index == None else len(self.index))
+        self.metrics.gauge("expiry_scheduled", "drops awaiting expiry",
+            lambda: len(self.expiry))
+        self.metrics.gauge("partial_uploads", "incomplete resumable uploads",
+            lambda: len(self.partials))
+        self.metrics.gauge("keys", "keys of encrypted drops",
+            lambda: len(self.keys))
 
 if __name__ == "__main__":
-    class AddressConfig(baseserver.TCPConfig):
+    class AddressConfig(SDropConfig):
         ADDRESS = ("::1", 8000, 0 , 0)
     
     #mkconfig
+
+    def mkserver(worker = 0):
+        server = SDropServer(sock_config = AddressConfig, worker = worker)
+        server.thread(baseserver.threaded.Multiplexing())
+        return server
     
-    server = SDropServer(sock_config = AddressConfig)
-    server.thread(baseserver.threaded.Pipelining(nthreads = 1))
-    server()
+    if AddressConfig.PROCESSES > 1:
+        baseserver.Prefork(mkserver, AddressConfig, AddressConfig.PROCESSES)()
+    else:
+        mkserver()()